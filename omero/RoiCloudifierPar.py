@@ -1,4 +1,3 @@
-import io
 from lavlab.omero_util import (
     getImageAtResolution,
     getDownsampledXYDimensions,
@@ -7,107 +6,259 @@ from lavlab.omero_util import (
     getLargeRecon,
 )
 import time
+from collections import namedtuple
 
+import Ice
+import omero
+from omero.rtypes import rstring, unwrap
+from omero.sys import ParametersI
+from recon_cache import LargeReconCache
+from thumbnail_provider import ThumbnailProvider
+from thumbnail_provider import DEFAULT_CACHE_DIR as DEFAULT_THUMBNAIL_CACHE
+from stage_metrics import span, gauge, configure, writePrometheus
 
 # from lavlab.omero_util import saveObjects
-def saveObjects(conn, objects):
+UNSENT_ERRORS = (
+    Ice.ConnectFailedException,
+    Ice.ConnectTimeoutException,
+    Ice.DNSException,
+)
+"""errors raised before a request reaches the server, retrying those cannot save twice"""
+
+
+def saveObjects(
+    conn,
+    objects,
+    chunk_size=100,
+    retries=3,
+    backoff=2.0,
+    start=0,
+    saved_count=None,
+    on_chunk=None,
+):
+    """
+    saves objects in saveArray chunks, skipping the first start chunks.
+    saveArray is not idempotent, so only UNSENT_ERRORS are retried blindly. after any
+    other transient error saved_count() is asked how many of objects reached the server
+    and the chunk is retried only if it is not among them, without saved_count those
+    errors are raised. on_chunk(n) is called once n chunks are saved.
+    returns the number of saved chunks
+    """
     ous = conn.getUpdateService()
-    for obj in objects:
-        ous.saveAndReturnObject(obj)
-    ous.close()
+    chunks = start
+    for i in range(start * chunk_size, len(objects), chunk_size):
+        chunk = objects[i : i + chunk_size]
+        for attempt in range(retries + 1):
+            try:
+                ous.saveArray(chunk)
+                break
+            except (Ice.LocalException, omero.InternalException) as e:
+                if attempt == retries or (
+                    saved_count is None and not isinstance(e, UNSENT_ERRORS)
+                ):
+                    raise
+                print(f"saving chunk {i // chunk_size} failed ({e!r}), retrying...")
+                time.sleep(backoff * 2**attempt)
+                if not isinstance(e, UNSENT_ERRORS) and saved_count() >= i + len(chunk):
+                    break  # the chunk was saved, only the reply got lost
+        chunks += 1
+        if on_chunk is not None:
+            on_chunk(chunks)
+    return chunks
 
 
 from lavlab.python_util import draw_shapes
 
+RemoteCandidates = namedtuple("RemoteCandidates", ["primary_tn", "primary", "options"])
+"""primary remote image and its thumbnail (None if missing) plus extended search options"""
+
 
 class LLabOmeroNamespaceParser:
     """Translates local images to remote OMERO Images"""
 
     THUMBNAIL_SIZE = (256, 256)
-
-    def __init__(self, conn):
+    UPLOAD_TAG = "roi_cloudifier upload "
+    """roi description prefix of tagged uploads, followed by the upload id"""
+    SAVE_CHUNK_SIZE = 100
+    """rois per saveArray call"""
+
+    def __init__(self, conn, recon_cache=None, thumbnails=None, create_missing=True):
+        """
+        recon_cache and thumbnails are created when None, unless create_missing is
+        False, then they stay None for parsers that never load recons or thumbnails
+        """
         self.conn = conn
+        self.recon_cache = recon_cache
+        self.thumbnails = thumbnails
+        if create_missing and recon_cache is None:
+            self.recon_cache = LargeReconCache()
+        if create_missing and thumbnails is None:
+            self.thumbnails = ThumbnailProvider(conn, self.THUMBNAIL_SIZE)
+
+    def clone(self):
+        """parser on its own connection joined to the same session, for other threads"""
+        conn = self.conn.clone()
+        conn.connect(sUuid=self.conn.c.getSessionId())
+        return LLabOmeroNamespaceParser(
+            conn, self.recon_cache, self.thumbnails, create_missing=False
+        )
 
-    def findPrimaryRemoteImage(self, details):
-        start = time.time()
-        """gets remote image based off parsed image details)"""
+    def fetchThumbnails(self, imgs):
+        """gets the thumbnails of imgs, cached or in batched calls, PIL images in order"""
+        if not imgs:
+            return []
+        return self.thumbnails.get(imgs)
+
+    def _findPrimaryImage(self, details):
         project_id, patient_id, slide_id = details
         slide_num = slide_id[0]
         # slide_id from Siren
 
         # img_obj from llab omero filenaming convention
         print(f"N{patient_id}_S{slide_num}_HE.ome.tiff")
-        img = self.conn.getObject(
+        return self.conn.getObject(
             "Image", attributes={"name": f"N{patient_id}_S{slide_num}_HE.ome.tiff"}
         )
 
+    def _findExtendedImages(self, details):
+        project_id, patient_id, slide_id = details
+        slide_num = slide_id[0]
+        # get all images from dataset and match using pattern
+        dataset = self.conn.getObject(
+            "Dataset", attributes={"name": f"{patient_id}_{project_id.lower()[0]}"}
+        )
+        if dataset is None:
+            return []
+        return [
+            img
+            for img in dataset.listChildren()
+            if re.match(".*_S" + slide_num + ".*", img.getName())
+        ]
+
+    @span("findPrimaryRemoteImage")
+    def findPrimaryRemoteImage(self, details):
+        """gets remote image based off parsed image details)"""
+        img = self._findPrimaryImage(details)
         if img is not None:
             # thumbnail
-            tn = Image.open(io.BytesIO(img.getThumbnail(self.THUMBNAIL_SIZE)))
-            print(f"findPrimaryRemoteImage took: {time.time()-start}")
+            (tn,) = self.fetchThumbnails([img])
             return tn, img
-        print(f"findPrimaryRemoteImage took: {time.time()-start}")
         return None, None
 
+    @span("extendedRemoteImgSearch")
     def extendedRemoteImgSearch(self, details):
         """Find extra image options if possible"""
-        start = time.time()
-        project_id, patient_id, slide_id = details
-        slide_num = slide_id[0]
-        # get all images from dataset and match using pattern
-        dataset = self.conn.getObject(
-            "Dataset", attributes={"name": f"{patient_id}_{project_id.lower()[0]}"}
-        )
-        rv = []
-        for img in dataset.listChildren():
-            name = img.getName()
-            if re.match(".*_S" + slide_num + ".*", name):
-                tn = Image.open(io.BytesIO(img.getThumbnail(self.THUMBNAIL_SIZE)))
-                obj = img
-                rv.append({"thumbnail": tn, "obj": obj, "name": name})
-        print(f"extendedRemoteImgSearch took: {time.time()-start}")
+        imgs = self._findExtendedImages(details)
+        rv = [
+            {"thumbnail": tn, "obj": img, "name": img.getName()}
+            for img, tn in zip(imgs, self.fetchThumbnails(imgs))
+        ]
         return rv
 
+    @span("findRemoteCandidates")
+    def findRemoteCandidates(self, details):
+        """primary image and extended search options, all thumbnails in one call"""
+        primary = self._findPrimaryImage(details)
+        imgs = self._findExtendedImages(details)
+        extended_ids = {img.getId() for img in imgs}
+        if primary is not None and primary.getId() not in extended_ids:
+            imgs.append(primary)
+        tns = dict(zip([img.getId() for img in imgs], self.fetchThumbnails(imgs)))
+        options = [
+            {"thumbnail": tns[img.getId()], "obj": img, "name": img.getName()}
+            for img in imgs
+            if img.getId() in extended_ids
+        ]
+        primary_tn = None if primary is None else tns[primary.getId()]
+        return RemoteCandidates(primary_tn, primary, options)
+
+    @span("getRegistrationImage")
     def getRegistrationImage(self, img, details):
-        """gets registration img"""
-        start = time.time()
+        """gets registration img, reusing the large recon cache across attempts and runs"""
         project_id, patient_id, slide_id = details
         slide_num, downsample_factor = slide_id
+        lr_arr = self.recon_cache.getOrCreate(
+            img,
+            downsample_factor,
+            lambda: self._downloadLargeRecon(img, downsample_factor),
+        )
+        return Image.fromarray(lr_arr)
+
+    @staticmethod
+    def _downloadLargeRecon(img, downsample_factor):
         lr_obj, lr_img = getLargeRecon(img, downsample_factor)
+        with lr_img:
+            lr_arr = np.array(lr_img)
         os.remove(lr_img.filename)
-        print(f"getRegistrationImage took: {time.time()-start}")
-        return lr_img
+        return lr_arr
 
+    @span("createRemoteRois")
     def createRemoteRois(self, remote_img, remote_img_bin, warped_contours, details):
         """creates and returns omero rois from contours"""
-        start = time.time()
+        rois = self.buildRemoteRois(remote_img, warped_contours, details)
+        r_tn = self.drawRemoteRois(remote_img_bin, warped_contours)
+        return r_tn, rois
+
+    def buildRemoteRois(self, remote_img, warped_contours, details, upload_id=None):
+        """
+        creates omero rois from contours, scaled back to full resolution.
+        upload_id tags the rois so countUploadedRois finds them after a lost reply
+        """
         rois = []
+        downsample_factor = int(details[-1][-1])
         for id, rgb, xy in warped_contours:
             # scale coords back to full res for upload
-            xy2 = np.copy(xy)
-            for axis in xy2:
-                for i, coord in enumerate(axis):
-                    axis[i] = coord * int(details[-1][-1])
+            xy2 = np.asarray(xy, np.float64) * downsample_factor
             # create roi
             polygon = createPolygon(
                 xy2, z=0, t=0, comment="Transferred Annotation", rgb=rgb
             )
-            rois.append(createRoi(remote_img, [polygon]))
+            roi = createRoi(remote_img, [polygon])
+            if upload_id is not None:
+                roi.setDescription(rstring(self.UPLOAD_TAG + upload_id))
+            rois.append(roi)
+        return rois
 
+    def drawRemoteRois(self, remote_img_bin, warped_contours):
+        """draws contours onto the remote registration image, returns a thumbnail"""
         # remote_bin = np.array(remote_img_bin)
-        d_start = time.time()
-        _ = draw_shapes(remote_img_bin, warped_contours)
-        print(f"drawing shapes took: {time.time()-d_start}")
+        with span("drawing shapes"):
+            _ = draw_shapes(remote_img_bin, warped_contours)
         # r_tn = Image.fromarray(remote_bin)
-
-        print(f"createRemoteRois took: {time.time()-start}")
-        return remote_img_bin.resize(self.THUMBNAIL_SIZE), rois
-
-    def saveRemoteRois(self, rois):
-        """uploads/saves the output created by createRemoteRois"""
-        start = time.time()
-        saveObjects(self.conn, rois)
-        print(f"saveRemoteRois took: {time.time()-start}")
+        return remote_img_bin.resize(self.THUMBNAIL_SIZE)
+
+    def countUploadedRois(self, upload_id):
+        """number of rois on the server built with upload_id"""
+        params = ParametersI()
+        params.addString("description", self.UPLOAD_TAG + upload_id)
+        rows = self.conn.getQueryService().projection(
+            "select count(r) from Roi r where r.description = :description",
+            params,
+            {"omero.group": "-1"},
+        )
+        return unwrap(rows[0][0])
+
+    @span("saveRemoteRois")
+    def saveRemoteRois(self, rois, upload_id=None, on_chunk=None):
+        """
+        uploads/saves the output created by createRemoteRois.
+        rois tagged with upload_id can be retried after any transient error, and the
+        chunks an earlier attempt with the same upload_id saved are skipped.
+        returns the number of saved chunks
+        """
+        if upload_id is None:
+            return saveObjects(self.conn, rois, self.SAVE_CHUNK_SIZE)
+        saved_count = lambda: self.countUploadedRois(upload_id)
+        # chunks are saved whole and in order, only the last one can be short
+        start = -(-saved_count() // self.SAVE_CHUNK_SIZE)
+        return saveObjects(
+            self.conn,
+            rois,
+            self.SAVE_CHUNK_SIZE,
+            start=start,
+            saved_count=saved_count,
+            on_chunk=on_chunk,
+        )
 
 
 import re
@@ -118,11 +269,38 @@ from skimage import measure
 from skimage.io import imread
 from PIL import Image
 
-from lavlab.python_util import get_color_region_contours
+from scipy import ndimage
+from siren_index import SirenIndex, DEFAULT_INDEX_PATH
+from job_journal import JobJournal, fileFingerprint
 
 offset = (3, 0, 2)
 
 
+def color_label_image(img, rgb_vals, tolerance=0, strip_rows=1024):
+    """
+    Maps an RGB image to uint8 labels in one pass, label i + 1 is rgb_vals[i], 0 is none.
+
+    Pixels are packed into one 24 bit integer and looked up in a table holding every
+    colour within tolerance (per channel) of an rgb_val, earlier rgb_vals win overlaps.
+    Works in strips of strip_rows so the packed copy stays small.
+    """
+    lut = np.zeros(1 << 24, np.uint8)
+    steps = np.arange(-tolerance, tolerance + 1)
+    for label, rgb in reversed(list(enumerate(rgb_vals, 1))):
+        r, g, b = (np.clip(c + steps, 0, 255).astype(np.uint32) for c in rgb)
+        lut[(r[:, None, None] << 16) | (g[None, :, None] << 8) | b[None, None, :]] = (
+            label
+        )
+
+    img = np.asarray(img)
+    labels = np.empty(img.shape[:2], np.uint8)
+    for y in range(0, img.shape[0], strip_rows):
+        strip = img[y : y + strip_rows].astype(np.uint32)
+        packed = (strip[..., 0] << 16) | (strip[..., 1] << 8) | strip[..., 2]
+        labels[y : y + strip_rows] = lut[packed]
+    return labels
+
+
 class SirenFileReader:
     """parses paths to single resolution annotated tiff images found on Siren"""
 
@@ -137,6 +315,16 @@ class SirenFileReader:
 
     GENEROUS = True
 
+    ROI_COLOR_TOLERANCE = 0
+    """per channel difference still counted as an ROI_RGB_VALS colour"""
+
+    def __init__(self, index_path=None):
+        """index_path: sqlite file of a SirenIndex, None globs the volume every run"""
+        self.index_path = index_path
+
+    def _openIndex(self):
+        return SirenIndex(self, self.index_path)
+
     ROI_RGB_VALS = [  # green fails
         (0, 0, 0),
         (5, 1, 4),
@@ -168,6 +356,11 @@ class SirenFileReader:
     def searchDirectory(self, path):
         """search for annotated large recons recursively"""
         print(path)
+        if self.index_path is not None:
+            with self._openIndex() as index:
+                print(f"indexed {index.update(path)} new or changed recons")
+                yield from index.thumbnails(path)
+            return
         for file in glob.glob(f"{path}{self.FN_GLOB}", recursive=True):
             print(file)
             if not os.path.isfile(file):
@@ -176,85 +369,217 @@ class SirenFileReader:
                 print(img.mode)
                 yield img.resize(self.THUMBNAIL_SIZE), file
 
-    def getRegistrationImage(self, path: str):
-        pattern = re.sub(self.ANNOT_TO_REG[0], self.ANNOT_TO_REG[1], path)
-        for file in glob.glob(pattern):
+    def registrationPattern(self, path):
+        """glob pattern of the registration images belonging to an annotated recon"""
+        return re.sub(self.ANNOT_TO_REG[0], self.ANNOT_TO_REG[1], path)
+
+    def findRegistrationPath(self, path: str):
+        """registration image of an annotated recon, None if there is none"""
+        if self.index_path is not None:
+            with self._openIndex() as index:
+                recon = index.lookup(path)
+            if recon is not None:
+                return recon.registration_path
+        for file in glob.glob(self.registrationPattern(path)):
             if os.path.isfile(file):
-                return Image.open(file)
+                return file
+        return None
+
+    def fingerprint(self, path: str):
+        """changes whenever the annotated recon or its registration image changes"""
+        return fileFingerprint(path, self.findRegistrationPath(path))
+
+    def getRegistrationImage(self, path: str):
+        file = self.findRegistrationPath(path)
+        if file is not None:
+            return Image.open(file)
         if self.GENEROUS is True:
             print(path)
             return Image.open(path)
         else:
             raise FileNotFoundError
 
+    @span("getRoiContours")
     def getRoiContours(self, path):
-        """returns roi contours. generated from thresholded region of interest"""
-        start = time.time()
+        """returns roi contours (id, rgb, (x, y) points). generated from colour labels"""
         rv = []
-        raw_img = Image.open(path)
-        with raw_img.convert("RGB") as img:
-            for rgb in self.ROI_RGB_VALS:
-                contours = get_color_region_contours(img, rgb)
-                if contours:
-                    rv.extend(contours)
-        raw_img.close()
-        print(f"getRoiContours took: {time.time()-start}")
+        with Image.open(path) as raw_img, raw_img.convert("RGB") as img:
+            labels = color_label_image(img, self.ROI_RGB_VALS, self.ROI_COLOR_TOLERANCE)
+        # bounding boxes of every label in one pass, contours only look inside them
+        for label, bbox in enumerate(ndimage.find_objects(labels), 1):
+            if bbox is None:
+                continue
+            rgb = self.ROI_RGB_VALS[label - 1]
+            # pad so regions touching the crop edge still close
+            crop = np.pad(labels[bbox] == label, 1)
+            origin = np.array([bbox[1].start - 1, bbox[0].start - 1])
+            for contour in measure.find_contours(crop, 0.5):
+                rv.append((len(rv), rgb, contour[:, ::-1] + origin))
         print(f"found {len(rv)} rois!")
         return rv
 
 
 from tempfile import TemporaryDirectory
+import fcntl
+import hashlib
+import shutil
 from valis import registration
 from valis.serial_rigid import SerialRigidRegistrar
 from skimage.io import imsave
 
+REGISTRATION_CACHE = os.environ.get(
+    "REGISTRATION_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "valis_registrations"),
+)
 
-class ValisLargeReconRoiRegistrar:
-    """Registers single resolution tiff/jpeg/png files. NOT FOR FULL RESOLUTION COREGISTRATION!"""
+# images are handed to valis through tmpfs when there is one, skipping the disk
+HANDOFF_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def image_digest(img: Image.Image):
+    """sha1 of an image's mode, size and pixels"""
+    digest = hashlib.sha1(f"{img.mode}:{img.size}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
 
-    registrar = registration.Valis(
-        os.devnull, os.devnull, img_list=[], imgs_ordered=True
-    )
 
-    def transfer_rois(rois, local_img: Image.Image, remote_img):
-        """Coregisters local_img and remote_img, then uses that info to transfer the rois"""
-        start = time.time()
-        with TemporaryDirectory() as workdir:
-            s_start = time.time()
-            local = workdir + os.sep + "local.ome.tiff"
-            remote = workdir + os.sep + "remote.ome.tiff"
-            local_img.save(local)
-            remote_img.save(remote)
-            # imsave(local, np.array(local_img))
-            # imsave(remote, np.array(remote_img))
+class ValisLargeReconRoiRegistrar:
+    """Registers single resolution tiff/jpeg/png files. NOT FOR FULL RESOLUTION COREGISTRATION!
+
+    Registrations are kept in REGISTRATION_CACHE keyed by the content of both images, so
+    a pair that was registered before only has its contours warped."""
+
+    def register(local_img: Image.Image, remote_img):
+        """returns the registrar pickle and summarize_error of a (cached) registration"""
+        key = hashlib.sha1(
+            (image_digest(local_img) + image_digest(remote_img)).encode()
+        ).hexdigest()
+        cached = os.path.join(REGISTRATION_CACHE, key)
+        os.makedirs(REGISTRATION_CACHE, exist_ok=True)
+        # one worker registers a pair, others wait and reuse it
+        with open(cached + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(os.path.join(cached, "error.txt")):
+                ValisLargeReconRoiRegistrar._register(local_img, remote_img, cached)
+        (registrar_f,) = glob.glob(cached + "/**/*_registrar.pickle", recursive=True)
+        with open(os.path.join(cached, "error.txt")) as f:
+            return registrar_f, float(f.read())
+
+    def _register(local_img: Image.Image, remote_img, dst):
+        shutil.rmtree(dst, ignore_errors=True)  # leftovers of an interrupted run
+        with TemporaryDirectory(dir=HANDOFF_DIR) as workdir:
+            src = workdir + os.sep + "src"
+            os.mkdir(src)
+            with span("save"):
+                local_img.save(src + os.sep + "local.tiff")
+                remote_img.save(src + os.sep + "remote.tiff")
             # coregister images
-            v_start = time.time()
-            print(f"save took: {v_start-s_start}")
-            ValisLargeReconRoiRegistrar.registrar.__init__(
-                workdir,
-                workdir + os.sep + "out/",
-                reference_img_f="remote.jpeg",
-                align_to_reference=True,
+            with span("valis"):
+                registrar = registration.Valis(
+                    src, dst, reference_img_f="remote.tiff", align_to_reference=True
+                )
+                (
+                    rigid_registrar,
+                    non_rigid_registrar,
+                    error_df,
+                ) = registrar.register()
+            probe = ValisLargeReconRoiRegistrar.probe_points(local_img)
+            expected = ValisLargeReconRoiRegistrar.warp_probe(registrar, probe)
+        ValisLargeReconRoiRegistrar.prune(dst, probe, expected)
+        # written last, marks the entry complete
+        with open(os.path.join(dst, "error.txt"), "w") as f:
+            f.write(repr(ValisLargeReconRoiRegistrar.summarize_error(error_df)))
+
+    PRUNED_DIRS = (
+        "overlaps",
+        "rigid_registration",
+        "non_rigid_registration",
+        "deformation_fields",
+    )
+    """valis outputs that are only pictures of the registration, never read on reload"""
+
+    def probe_points(img: Image.Image):
+        """corners, edge midpoints and center of img as (9, 2) x,y"""
+        w, h = img.size
+        return np.array(
+            [(x, y) for x in (0, w / 2, w - 1) for y in (0, h / 2, h - 1)], np.float64
+        )
+
+    def warp_probe(registrar, probe):
+        """warps probe from the local slide to the reference, like transfer_rois"""
+        return registrar.get_slide("local").warp_xy_from_to(
+            probe, registrar.get_ref_slide()
+        )
+
+    def prune(dst, probe, expected):
+        """
+        deletes PRUNED_DIRS of a registration, then checks that the registrar reloaded
+        from dst still warps probe to expected. the directories are moved aside first
+        and put back if the check fails, so a cache entry always warps like a fresh one
+        """
+        trash = os.path.join(dst, ".pruned")
+        moved = []
+        for results in glob.glob(os.path.join(dst, "*", "*")):
+            name = os.path.basename(results)
+            if (
+                os.path.isdir(results)
+                and name in ValisLargeReconRoiRegistrar.PRUNED_DIRS
+            ):
+                target = os.path.join(trash, os.path.relpath(results, dst))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(results, target)
+                moved.append((results, target))
+        try:
+            (registrar_f,) = glob.glob(dst + "/**/*_registrar.pickle", recursive=True)
+            warped = ValisLargeReconRoiRegistrar.warp_probe(
+                registration.load_registrar(registrar_f), probe
             )
-            (
-                rigid_registrar,
-                non_rigid_registrar,
-                error_df,
-            ) = ValisLargeReconRoiRegistrar.registrar.register()
-            print(f"valis took: {time.time()- v_start}")
-            annot_obj = ValisLargeReconRoiRegistrar.registrar.get_slide(local)
-            ref = ValisLargeReconRoiRegistrar.registrar.get_ref_slide()
-            w_start = time.time()
-            for i, shape in enumerate(rois):
-                id, rgb_val, contour = shape
-                # contour = [(y,x) for x,y in contour]
-                warped_contour = annot_obj.warp_xy_from_to(contour, ref)
-                warped_contour = [tuple(xy) for xy in warped_contour]
-                rois[i] = (id, rgb_val, warped_contour)
-            print(f"warping took: {time.time() - w_start}")
-        print(f"transfer_rois took: {time.time()-start}")
+            intact = np.allclose(warped, expected, atol=1e-3)
+        except Exception as e:
+            print(f"reloading the pruned registration failed: {e!r}")
+            intact = False
+        if not intact:
+            print(f"pruned registration warps differently, keeping all of {dst}")
+            for results, target in moved:
+                os.replace(target, results)
+        shutil.rmtree(trash, ignore_errors=True)
+
+    @span("transfer_rois")
+    def transfer_rois(rois, local_img: Image.Image, remote_img, return_error=False):
+        """Coregisters local_img and remote_img, then uses that info to transfer the rois
+
+        return_error also returns summarize_error of the registration"""
+        registrar_f, error = ValisLargeReconRoiRegistrar.register(local_img, remote_img)
+        registrar = registration.load_registrar(registrar_f)
+        annot_obj = registrar.get_slide("local")
+        ref = registrar.get_ref_slide()
+
+        # every contour in one call, then split back per roi
+        contours = [
+            np.asarray(contour, np.float64).reshape(-1, 2) for _, _, contour in rois
+        ]
+        with span("warping"):
+            if contours:
+                warped = annot_obj.warp_xy_from_to(np.concatenate(contours), ref)
+                splits = np.cumsum([len(contour) for contour in contours])[:-1]
+                for i, warped_contour in enumerate(np.split(warped, splits)):
+                    id, rgb_val, _ = rois[i]
+                    rois[i] = (id, rgb_val, [tuple(xy) for xy in warped_contour])
+        if return_error:
+            return rois, error
         return rois
 
+    def summarize_error(error_df):
+        """mean relative target registration error of the last stage valis measured, nan if unknown"""
+        if error_df is None:
+            return float("nan")
+        for column in ("non_rigid_rTRE", "rigid_rTRE"):
+            if column in error_df:
+                values = np.asarray(error_df[column], dtype=float)
+                if np.isfinite(values).any():
+                    return float(np.nanmean(values))
+        return float("nan")
+
 
 import time
 import tkinter as tk
@@ -265,16 +590,28 @@ from PIL import ImageTk
 class TKWindowManager:
     """Manages UI Window/Frames with TK"""
 
-    window = tk.Tk()
-    current_frame = tk.Frame(window)
-    tk.Label(
-        current_frame,
-        text="Welcome to ROI Cloudifier!",
-        font=tkFont.Font(window, size=32),
-    ).pack()
-    tk.Label(
-        current_frame, text="Starting...", font=tkFont.Font(window, size=32)
-    ).pack()
+    window = None
+    current_frame = None
+
+    def start():
+        """opens the window on a startup screen, worker processes never call this"""
+        if TKWindowManager.window is not None:
+            return
+        window = tk.Tk()
+        TKWindowManager.window = window
+        TKWindowManager.current_frame = tk.Frame(window)
+        tk.Label(
+            TKWindowManager.current_frame,
+            text="Welcome to ROI Cloudifier!",
+            font=tkFont.Font(window, size=32),
+        ).pack()
+        tk.Label(
+            TKWindowManager.current_frame,
+            text="Starting...",
+            font=tkFont.Font(window, size=32),
+        ).pack()
+        TKWindowManager.current_frame.pack()
+        TKWindowManager.update()
 
     def update():
         TKWindowManager.window.update_idletasks()
@@ -377,12 +714,162 @@ class TKWindowManager:
         TKWindowManager.update()
 
 
-# startup screen
-TKWindowManager.current_frame.pack()
-TKWindowManager.update()
-
 from queue import Queue
+from collections import deque
 import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing.util import Finalize
+
+
+def connect():
+    """opens the OMERO session used by the main process and every worker"""
+    conn = BlitzGateway("", "", host="", port="", secure=True)
+    conn.connect()
+    conn.keepAlive()
+    return conn
+
+
+_worker = threading.local()
+"""per worker session, parsers and registrar, set up by _init_worker"""
+
+
+def _init_worker(local_parser, registrar, conn_factory):
+    """executor initializer, gives every worker its own session and registrar"""
+    conn = conn_factory()
+    conn.SERVICE_OPTS.setOmeroGroup("-1")
+    conn.c.enableKeepAlive(60)
+    Finalize(conn, conn.close, exitpriority=10)
+    _worker.conn = conn
+    _worker.local_parser = local_parser
+    # workers never fetch thumbnails, a provider here would leak its pool and threads
+    _worker.remote_parser = LLabOmeroNamespaceParser(
+        conn, LargeReconCache(), create_missing=False
+    )
+    _worker.registrar = registrar
+
+
+@span("process_image")
+def _process_image(task):
+    """contour extraction, registration and roi drawing for one slide"""
+    local_tn, local_annot_path, remote_img_id, details = task
+    remote_img_ref = _worker.conn.getObject("Image", remote_img_id)
+    local_roi_contours = _worker.local_parser.getRoiContours(local_annot_path)
+    with _worker.local_parser.getRegistrationImage(local_annot_path) as local_reg_img:
+        with _worker.remote_parser.getRegistrationImage(
+            remote_img_ref, details
+        ) as remote_reg_img:
+            warped_contours, error = _worker.registrar.transfer_rois(
+                local_roi_contours, local_reg_img, remote_reg_img, return_error=True
+            )
+            roi_tn = _worker.remote_parser.drawRemoteRois(
+                remote_reg_img, warped_contours
+            )
+    return local_tn, local_annot_path, roi_tn, warped_contours, error
+
+
+import hashlib
+import pickle
+import uuid
+
+
+def thumbnail_similarity(local_tn, remote_tn, size=(128, 128)):
+    """normalized cross correlation of two thumbnails in grayscale, 1 is identical"""
+    a = np.asarray(local_tn.convert("L").resize(size), np.float32)
+    b = np.asarray(remote_tn.convert("L").resize(size), np.float32)
+    a = (a - a.mean()) / (a.std() + 1e-6)
+    b = (b - b.mean()) / (b.std() + 1e-6)
+    return float((a * b).mean())
+
+
+def prefetch(items, prepare, depth=4):
+    """
+    Yields prepare(*item) for every item in order, running it up to depth items ahead on
+    a background thread so results are usually ready when asked for.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(1) as executor:
+        pending = deque(
+            executor.submit(prepare, *item) for _, item in zip(range(depth), items)
+        )
+        while pending:
+            future = pending.popleft()
+            for item in items:
+                pending.append(executor.submit(prepare, *item))
+                break
+            yield future.result()
+
+
+class RegistrationGate:
+    """Decides headless matches and transfers, only borderline cases need a person"""
+
+    ACCEPT = "accept"
+    REJECT = "reject"
+    REVIEW = "review"
+
+    def __init__(
+        self, accept_error=0.01, reject_error=0.05, accept_score=0.8, reject_score=0.4
+    ):
+        """
+        accept_error/reject_error: relative registration error (rTRE) at or below which
+            a transfer is accepted, and above which it is rejected.
+        accept_score/reject_score: thumbnail_similarity at or above which a remote image
+            match is accepted, and below which it is rejected.
+        """
+        self.accept_error = accept_error
+        self.reject_error = reject_error
+        self.accept_score = accept_score
+        self.reject_score = reject_score
+
+    def match(self, score):
+        if score >= self.accept_score:
+            return self.ACCEPT
+        if score < self.reject_score:
+            return self.REJECT
+        return self.REVIEW
+
+    def transfer(self, error):
+        if not np.isfinite(error):  # valis could not measure it
+            return self.REVIEW
+        if error <= self.accept_error:
+            return self.ACCEPT
+        if error > self.reject_error:
+            return self.REJECT
+        return self.REVIEW
+
+
+class ReviewQueue:
+    """Borderline headless decisions, pickled to a directory to be worked through later"""
+
+    def __init__(self, directory="review_queue"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, kind, local_annot_path, **item):
+        """kind is "match" or "transfer", item holds whatever the review needs"""
+        item.update(kind=kind, local_annot_path=local_annot_path)
+        name = hashlib.sha1(local_annot_path.encode()).hexdigest() + ".pkl"
+        tmp = os.path.join(self.directory, name + ".tmp")
+        with open(tmp, "wb") as file:
+            pickle.dump(item, file)
+        os.replace(tmp, os.path.join(self.directory, name))
+
+    def __iter__(self):
+        """yields (item path, item) oldest first"""
+        paths = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".pkl")
+        ]
+        for path in sorted(paths, key=os.path.getmtime):
+            with open(path, "rb") as file:
+                yield path, pickle.load(file)
+
+    def __len__(self):
+        return sum(name.endswith(".pkl") for name in os.listdir(self.directory))
+
+    def done(self, item_path):
+        os.remove(item_path)
 
 
 class RoiCloudifier:
@@ -395,171 +882,615 @@ class RoiCloudifier:
         wm=TKWindowManager,
         registrar=ValisLargeReconRoiRegistrar,
         multichoice_default=False,
+        workers=0,
+        queue_size=None,
+        conn_factory=connect,
+        headless=False,
+        gate=None,
+        review_queue=None,
+        prefetch_depth=4,
+        journal=None,
+        registrations_dir=None,
     ) -> None:
+        """
+        workers: 0 processes slides on one background thread, more starts a process pool
+            where every worker has its own OMERO session and registrar.
+        queue_size: how many matched slides may wait for processing before matching
+            blocks, defaults to twice the worker count.
+        conn_factory: picklable callable returning a connected BlitzGateway.
+        headless: decide matches and transfers with gate instead of asking through wm,
+            borderline cases are put in review_queue for work_review_queue.
+        prefetch_depth: how many upcoming slides get their remote candidates and
+            thumbnails resolved in the background while the current one is reviewed.
+        journal: JobJournal of finished stages, slides whose inputs did not change
+            resume after their last finished stage.
+        registrations_dir: registered slides are pickled here, so resuming them skips
+            contour extraction and registration. defaults to <journal>_registrations.
+        """
         self.local_parser = local_parser
         self.remote_parser = remote_parser
-        self.image_processing_queue = Queue()
+        self.workers = workers
+        self.image_processing_queue = Queue(queue_size or 2 * max(workers, 1))
         self.image_processed_queue = Queue()
+        self.upload_queue = Queue()
+        self.conn_factory = conn_factory
+        # remote image wrappers stay in this process, workers get ids
+        self.remote_img_refs = {}
 
         self.wm = wm
         self.registrar = registrar
         self.multichoice_default = multichoice_default
+        self.prefetch_depth = prefetch_depth
+        self.headless = headless
+        self.gate = RegistrationGate() if gate is None else gate
+        self.review_queue = ReviewQueue() if review_queue is None else review_queue
+        self.journal = JobJournal() if journal is None else journal
+        self.registrations_dir = (
+            registrations_dir
+            or os.path.splitext(self.journal.path)[0] + "_registrations"
+        )
+        os.makedirs(self.registrations_dir, exist_ok=True)
+        self.fingerprints = {}
         self.succeded = []
         self.failed = []
+        self.deferred = []
+        self.skipped = []
+
+    def fingerprint(self, local_img_path):
+        """fingerprint of a slide's inputs, taken once per run"""
+        if local_img_path not in self.fingerprints:
+            self.fingerprints[local_img_path] = self.local_parser.fingerprint(
+                local_img_path
+            )
+        return self.fingerprints[local_img_path]
 
-    def fail(self, local_img_path):
+    def record(self, local_img_path, stage, **data):
+        """journals a finished stage of a slide"""
+        self.journal.record(
+            local_img_path, stage, self.fingerprint(local_img_path), **data
+        )
+
+    def resume(self, local_img_path):
+        """finished stages of a slide, {stage: data}"""
+        return self.journal.resume(local_img_path, self.fingerprint(local_img_path))
+
+    def fail(self, local_img_path, reason=None):
         """registers failure"""
         self.failed.append(local_img_path)
+        self.record(local_img_path, "failed", reason=reason)
+
+    def save_registration(self, local_img_path, roi_tn, warped_contours, error):
+        """pickles a processed slide and journals it as registered"""
+        name = hashlib.sha1(local_img_path.encode()).hexdigest() + ".pkl"
+        path = os.path.join(self.registrations_dir, name)
+        with open(path + ".tmp", "wb") as file:
+            pickle.dump((roi_tn, warped_contours, error), file)
+        os.replace(path + ".tmp", path)
+        self.record(local_img_path, "registered", error=error, result=path)
+
+    def load_registration(self, local_img_path):
+        """(roi_tn, warped_contours, error) of a registered slide, None if there is none"""
+        path = self.resume(local_img_path).get("registered", {}).get("result")
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as file:
+                return pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            print(f"Could not load the registration of {local_img_path}: {e!r}")
+            self.forget(local_img_path, "registered")
+            return None
+
+    def no_match(self, local_img_path):
+        """registers a slide without a matching remote image, reruns skip it"""
+        self.failed.append(local_img_path)
+        self.record(local_img_path, "matched", remote_img_id=None)
+
+    def forget(self, local_img_path, *stages):
+        """journals that finished stages of a slide have to be redone"""
+        self.journal.forget(local_img_path, self.fingerprint(local_img_path), *stages)
+
+    def reject(self, local_img_path):
+        """registers rois that did not translate properly, reruns skip them"""
+        self.failed.append(local_img_path)
+        self.record(local_img_path, "reviewed", accepted=False)
 
     def success(self, local_img_path):
         """registers success"""
         self.succeded.append(local_img_path)
+        self.record(local_img_path, "uploaded")
+
+    def defer(self, kind, local_img_path, **item):
+        """registers a headless decision that needs a person"""
+        self.review_queue.put(kind, local_img_path, **item)
+        self.deferred.append(local_img_path)
+
+    def review_results(self):
+        """asks about every finished slide, saving the rois of accepted ones"""
+        gauge("queue_depth", self.image_processing_queue.qsize(), queue="processing")
+        gauge("queue_depth", self.image_processed_queue.qsize(), queue="processed")
+        gauge("queue_depth", self.upload_queue.qsize(), queue="upload")
+        while self.image_processed_queue.qsize() > 0:
+            result = self.image_processed_queue.get()
+            if isinstance(result[-1], Exception):
+                local_annot_path, error = result
+                print(f"Could not process {local_annot_path}: {error!r}")
+                self.remote_img_refs.pop(local_annot_path, None)
+                self.fail(local_annot_path, repr(error))
+                self.image_processed_queue.task_done()
+                continue
+            ltn, local_annot_path, rtn, warped_contours, error = result
+            remote_img_ref, details = self.remote_img_refs.pop(local_annot_path)
+            stages = self.resume(local_annot_path)
+            if "result" not in stages.get("registered", {}):
+                self.save_registration(local_annot_path, rtn, warped_contours, error)
+            if stages.get("reviewed", {}).get("accepted"):
+                # accepted before the last run stopped, only the upload is left
+                decision = RegistrationGate.ACCEPT
+            elif self.headless:
+                decision = self.gate.transfer(error)
+                print(f"{local_annot_path}: registration error {error:.4f}, {decision}")
+            elif self.wm.compare(ltn, rtn, "Did ROIs Translate Properly?") is True:
+                decision = RegistrationGate.ACCEPT
+            else:
+                decision = RegistrationGate.REJECT
+
+            if decision == RegistrationGate.ACCEPT:
+                self.record(local_annot_path, "reviewed", accepted=True)
+                self.upload(local_annot_path, remote_img_ref, warped_contours, details)
+            elif decision == RegistrationGate.REVIEW:
+                self.defer(
+                    "transfer",
+                    local_annot_path,
+                    local_tn=ltn.copy(),
+                    roi_tn=rtn.copy(),
+                    warped_contours=warped_contours,
+                    remote_img_id=remote_img_ref.getId(),
+                    details=details,
+                    error=error,
+                )
+            else:
+                self.reject(local_annot_path)
+            ltn.close()
+            rtn.close()
+            self.image_processed_queue.task_done()
+
+    def ask_match(self, local_reg_tn, candidates):
+        """asks for the remote image through the window manager"""
+        if self.multichoice_default is True:
+            return self.wm.compare_multichoice(local_reg_tn, candidates.options)
+        # if not multichoice, try to get most likely image
+        remote_tn, remote_img_ref = candidates.primary_tn, candidates.primary
+        # if image is available ask for a match, otherwise definitely not a match
+        force_multichoice = False
+        matching = False
+        if remote_img_ref is not None:
+            matching = self.wm.compare(local_reg_tn, remote_tn)
+        else:
+            force_multichoice = True
+        # if not a match, ask to do an extended search
+        if matching is False:
+            if force_multichoice is False:
+                force_multichoice = self.wm.ask("Should we do an extended search?")
+            if force_multichoice is True:
+                return self.wm.compare_multichoice(local_reg_tn, candidates.options)
+            return None, None
+        return remote_tn, remote_img_ref
+
+    def auto_match(self, local_tn, local_annot_path, local_reg_tn, details, candidates):
+        """scores the remote candidates and lets the gate decide, borderline is deferred"""
+        options = []
+        if self.multichoice_default is False and candidates.primary is not None:
+            options.append(
+                {
+                    "thumbnail": candidates.primary_tn,
+                    "obj": candidates.primary,
+                    "name": candidates.primary.getName(),
+                }
+            )
+        scores = [thumbnail_similarity(local_reg_tn, o["thumbnail"]) for o in options]
+        if not scores or self.gate.match(max(scores)) != RegistrationGate.ACCEPT:
+            options.extend(candidates.options)
+            scores = [
+                thumbnail_similarity(local_reg_tn, o["thumbnail"]) for o in options
+            ]
+        if not options:
+            return None, None
+
+        best = int(np.argmax(scores))
+        decision = self.gate.match(scores[best])
+        print(f"{local_annot_path}: best match score {scores[best]:.3f}, {decision}")
+        if decision == RegistrationGate.ACCEPT:
+            return options[best]["thumbnail"], options[best]["obj"]
+        if decision == RegistrationGate.REVIEW:
+            self.defer(
+                "match",
+                local_annot_path,
+                local_tn=local_tn.copy(),
+                local_reg_tn=local_reg_tn.copy(),
+                details=details,
+                options=[
+                    (o["name"], o["obj"].getId(), o["thumbnail"].copy(), score)
+                    for o, score in zip(options, scores)
+                ],
+            )
+        return None, None
 
-    def main(self, parent_dir):
-        """searches parent dir and translates rois from one image to the remote medium"""
+    def upload(self, local_annot_path, remote_img_ref, warped_contours, details):
+        """hands accepted rois to the upload stage"""
+        self.upload_queue.put(
+            (local_annot_path, remote_img_ref, warped_contours, details)
+        )
 
-        threading.Thread(target=self._process_images).start()
-        for local_tn, local_annot_path in self.local_parser.searchDirectory(parent_dir):
-            # first, gather results if available
-            while self.image_processed_queue.qsize() > 0:
-                (
-                    ltn,
-                    local_annot_path,
-                    rtn,
-                    roi_objs,
-                ) = self.image_processed_queue.get()
-                if self.wm.compare(ltn, rtn, "Did ROIs Translate Properly?") is True:
-                    self.remote_parser.saveRemoteRois(roi_objs)
+    def _upload_rois(self):
+        """upload stage, builds and saves rois on its own connection until None"""
+        remote_parser = self.remote_parser.clone()
+        try:
+            while True:
+                item = self.upload_queue.get()
+                if item is None:
+                    self.upload_queue.task_done()
+                    return
+                local_annot_path, remote_img_ref, warped_contours, details = item
+                # an interrupted upload keeps its id, its saved chunks are skipped.
+                # the id is journaled before anything is saved so a crash cannot lose it
+                uploading = self.resume(local_annot_path).get("uploading", {})
+                upload_id = uploading.get("upload_id") or uuid.uuid4().hex
+                on_chunk = lambda chunks: self.record(
+                    local_annot_path, "uploading", upload_id=upload_id, chunks=chunks
+                )
+                try:
+                    on_chunk(uploading.get("chunks", 0))
+                    roi_objs = remote_parser.buildRemoteRois(
+                        remote_img_ref, warped_contours, details, upload_id
+                    )
+                    remote_parser.saveRemoteRois(roi_objs, upload_id, on_chunk)
                     self.success(local_annot_path)
-                else:
-                    self.fail(local_annot_path)
-                ltn.close()
-                rtn.close()
-                self.image_processed_queue.task_done()
+                except Exception as e:
+                    print(f"Could not upload rois of {local_annot_path}: {e!r}")
+                    self.fail(local_annot_path, repr(e))
+                self.upload_queue.task_done()
+        finally:
+            remote_parser.conn.close(hard=False)
 
-            # try to find local registration image. just want thumbnail for now
-            local_reg_tn = None
-            try:
-                with self.local_parser.getRegistrationImage(
-                    local_annot_path
-                ) as local_reg_img:
-                    local_reg_tn = local_reg_img.resize(
-                        self.local_parser.THUMBNAIL_SIZE
-                    )
-            except FileNotFoundError:
-                print(
-                    "could not find registration image for this annotation. skipping..."
-                )
-                self.fail(local_annot_path)
-                continue
+    def _start_stages(self):
+        threading.Thread(target=self._process_images, daemon=True).start()
+        threading.Thread(target=self._upload_rois, daemon=True).start()
 
-            # get details and use them to give users option(s)
-            try:
-                details = self.local_parser.parse(local_annot_path)
-            except AttributeError:
-                print(f"File does not fit the capture groups: {local_annot_path}")
-                self.fail(local_annot_path)
+    def finish(self):
+        """waits for the remaining slides, reviewing them as they finish, and uploads"""
+        while self.image_processing_queue.unfinished_tasks > 0:
+            self.review_results()
+            time.sleep(0.2)
+        self.review_results()
+        self.upload_queue.put(None)
+        self.upload_queue.join()
+
+    def main(self, parent_dir):
+        """searches parent dir and translates rois from one image to the remote medium"""
+        if self.headless is False and hasattr(self.wm, "start"):
+            self.wm.start()
+
+        self._start_stages()
+        # candidates are looked up on their own connection, ahead of the reviewer
+        prefetch_parser = self.remote_parser.clone()
+        slides = prefetch(
+            self._pending_slides(parent_dir),
+            lambda local_tn, local_annot_path: self._prepare_slide(
+                local_tn, local_annot_path, prefetch_parser
+            ),
+            self.prefetch_depth,
+        )
+        try:
+            for slide in slides:
+                self._match_slide(*slide)
+            self.finish()
+        finally:
+            prefetch_parser.conn.close(hard=False)
+
+    def _pending_slides(self, parent_dir):
+        """slides of parent_dir whose journal says there is work left"""
+        for local_tn, local_annot_path in self.local_parser.searchDirectory(parent_dir):
+            stages = self.resume(local_annot_path)
+            if (
+                "uploaded" in stages
+                or stages.get("reviewed", {}).get("accepted") is False
+                or stages.get("matched", {"remote_img_id": 0})["remote_img_id"] is None
+            ):
+                self.skipped.append(local_annot_path)
                 continue
+            yield local_tn, local_annot_path
+
+    def _prepare_slide(self, local_tn, local_annot_path, remote_parser):
+        """
+        loads what matching a slide needs, runs on the prefetch thread.
+        returns (local_tn, local_annot_path, local_reg_tn, details, candidates),
+        local_reg_tn is an error message instead when the slide cannot be matched
+        """
+        # try to find local registration image. just want thumbnail for now
+        try:
+            with self.local_parser.getRegistrationImage(
+                local_annot_path
+            ) as local_reg_img:
+                local_reg_tn = local_reg_img.resize(self.local_parser.THUMBNAIL_SIZE)
+        except FileNotFoundError:
+            return (
+                local_tn,
+                local_annot_path,
+                "could not find registration image for this annotation. skipping...",
+                None,
+                None,
+            )
 
-            # find remote image
-            if self.multichoice_default is True:
-                remote_tn, remote_img_ref = self.wm.compare_multichoice(
-                    local_reg_tn, self.remote_parser.extendedRemoteImgSearch(details)
+        # get details and use them to give users option(s)
+        try:
+            details = self.local_parser.parse(local_annot_path)
+        except AttributeError:
+            return (
+                local_tn,
+                local_annot_path,
+                f"File does not fit the capture groups: {local_annot_path}",
+                None,
+                None,
+            )
+        candidates = None
+        if "matched" not in self.resume(local_annot_path):
+            candidates = remote_parser.findRemoteCandidates(details)
+        return local_tn, local_annot_path, local_reg_tn, details, candidates
+
+    def _match_slide(
+        self, local_tn, local_annot_path, local_reg_tn, details, candidates
+    ):
+        """matches a prepared slide and queues it for processing"""
+        # first, gather results if available
+        self.review_results()
+        if isinstance(local_reg_tn, str):
+            print(local_reg_tn)
+            self.fail(local_annot_path, local_reg_tn)
+            return
+
+        # find remote image
+        matched = self.resume(local_annot_path).get("matched")
+        if matched is not None:
+            # matched before the last run stopped
+            remote_img_ref = self.remote_parser.conn.getObject(
+                "Image", matched["remote_img_id"]
+            )
+            if remote_img_ref is None:
+                # deleted or moved out of reach since, everything after matching is void
+                print(f"matched image of {local_annot_path} is gone, matching again")
+                self.forget(
+                    local_annot_path, "matched", "registered", "reviewed", "uploading"
                 )
-            else:  # if not multichoice, try to get most likely image
-                remote_tn, remote_img_ref = self.remote_parser.findPrimaryRemoteImage(
-                    details
+                matched = None
+                candidates = self.remote_parser.findRemoteCandidates(details)
+        if matched is None:
+            if self.headless:
+                remote_tn, remote_img_ref = self.auto_match(
+                    local_tn, local_annot_path, local_reg_tn, details, candidates
                 )
-                # if image is available ask for a match, otherwise definitely not a match
-                force_multichoice = False
-                if remote_img_ref is not None:
-                    matching = self.wm.compare(local_reg_tn, remote_tn)
-                else:
-                    force_multichoice = True
-                # if not a match, ask to do an extended search
-                if matching is False:
-                    if force_multichoice is False:
-                        force_multichoice = self.wm.ask(
-                            "Should we do an extended search?"
-                        )
-                    if force_multichoice is True:
-                        remote_tn, remote_img_ref = self.wm.compare_multichoice(
-                            local_reg_tn,
-                            self.remote_parser.extendedRemoteImgSearch(details),
-                        )
-                    else:
-                        remote_tn, remote_img_ref = None, None
+                if local_annot_path in self.deferred:
+                    return
+            else:
+                remote_tn, remote_img_ref = self.ask_match(local_reg_tn, candidates)
+
+        # if no remote image fail
+        if remote_img_ref is None:
+            print(f"Could not find a remote copy of {local_annot_path}. skipping...")
+            if candidates is None or candidates.primary or candidates.options:
+                self.no_match(local_annot_path)
+            else:
+                self.fail(local_annot_path, "no remote candidates")
+            return
+
+        # put successful mapping into queue, blocks while the workers are behind
+        if matched is None:
+            self.record(
+                local_annot_path, "matched", remote_img_id=remote_img_ref.getId()
+            )
+        self.remote_img_refs[local_annot_path] = (remote_img_ref, details)
+        registration = None
+        if matched is not None:
+            registration = self.load_registration(local_annot_path)
+        if registration is not None:
+            # registered before the last run stopped, only the review is left
+            roi_tn, warped_contours, error = registration
+            self.image_processed_queue.put(
+                (local_tn, local_annot_path, roi_tn, warped_contours, error)
+            )
+            return
+        self.image_processing_queue.put(
+            (local_tn, local_annot_path, remote_img_ref.getId(), details)
+        )
 
-            # if no remote image fail
-            if remote_img_ref is None:
-                print(
-                    f"Could not find a remote copy of {local_annot_path}. skipping..."
+    def work_review_queue(self):
+        """asks about every deferred headless decision, accepted matches are processed"""
+        self.headless = False
+        if hasattr(self.wm, "start"):
+            self.wm.start()
+        self._start_stages()
+        conn = self.remote_parser.conn
+        for item_path, item in self.review_queue:
+            local_annot_path = item["local_annot_path"]
+            if item["kind"] == "transfer":
+                remote_img_ref = conn.getObject("Image", item["remote_img_id"])
+                if self.wm.compare(
+                    item["local_tn"], item["roi_tn"], "Did ROIs Translate Properly?"
+                ):
+                    self.record(local_annot_path, "reviewed", accepted=True)
+                    self.upload(
+                        local_annot_path,
+                        remote_img_ref,
+                        item["warped_contours"],
+                        item["details"],
+                    )
+                else:
+                    self.reject(local_annot_path)
+            else:
+                options = [
+                    {
+                        "thumbnail": tn,
+                        "obj": conn.getObject("Image", img_id),
+                        "name": f"{name} ({score:.2f})",
+                    }
+                    for name, img_id, tn, score in item["options"]
+                ]
+                _, remote_img_ref = self.wm.compare_multichoice(
+                    item["local_reg_tn"], options
                 )
-                self.fail(local_annot_path)
-                continue
-
-            # put successful mapping into queue
-            self.image_processing_queue.put(
-                (local_tn, local_annot_path, remote_img_ref, details)
-            )
+                if remote_img_ref is None:
+                    self.no_match(local_annot_path)
+                else:
+                    self.record(
+                        local_annot_path,
+                        "matched",
+                        remote_img_id=remote_img_ref.getId(),
+                    )
+                    self.remote_img_refs[local_annot_path] = (
+                        remote_img_ref,
+                        item["details"],
+                    )
+                    self.image_processing_queue.put(
+                        (
+                            item["local_tn"],
+                            local_annot_path,
+                            remote_img_ref.getId(),
+                            item["details"],
+                        )
+                    )
+            self.review_queue.done(item_path)
+            self.review_results()
+        self.finish()
 
     def _process_images(self):
-        conn = BlitzGateway(
-            "", "", host="", port="", secure=True
-        )
-        try:
-            conn.connect()
-            conn.keepAlive()
+        """feeds queued slides to the executor, at most one extra slide per worker"""
+        if self.workers > 0:
+            # spawn, forking this thread would copy the Ice communicator, the Tk root
+            # and locks held by the prefetch and upload threads into the workers
+            executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.local_parser, self.registrar, self.conn_factory),
+            )
+        else:
+            executor = ThreadPoolExecutor(
+                1,
+                initializer=_init_worker,
+                initargs=(self.local_parser, self.registrar, self.conn_factory),
+            )
+        in_flight = threading.BoundedSemaphore(2 * max(self.workers, 1))
+
+        def done(future, local_annot_path):
+            error = future.exception()
+            if error is None:
+                self.image_processed_queue.put(future.result())
+            else:
+                self.image_processed_queue.put((local_annot_path, error))
+            in_flight.release()
+            # Mark the task as done
+            self.image_processing_queue.task_done()
+
+        with executor:
             while True:
                 # Get the next image processing task from the queue
-                (
-                    local_tn,
-                    local_annot_path,
-                    remote_img_ref,
-                    details,
-                ) = self.image_processing_queue.get()
-
-                local_roi_contours = self.local_parser.getRoiContours(local_annot_path)
-
-                with self.local_parser.getRegistrationImage(
-                    local_annot_path
-                ) as local_reg_img:
-                    with self.remote_parser.getRegistrationImage(
-                        remote_img_ref, details
-                    ) as remote_reg_img:
-                        warped_contours = self.registrar.transfer_rois(
-                            local_roi_contours, local_reg_img, remote_reg_img
-                        )
-
-                        roi_tn, roi_objs = self.remote_parser.createRemoteRois(
-                            remote_img_ref, remote_reg_img, warped_contours, details
-                        )
-                        self.image_processed_queue.put(
-                            (
-                                local_tn,
-                                local_annot_path,
-                                roi_tn,
-                                roi_objs,
-                            )
-                        )
-                # Mark the task as done
-                self.image_processing_queue.task_done()
-        finally:
-            conn.close()
+                task = self.image_processing_queue.get()
+                in_flight.acquire()
+                future = executor.submit(_process_image, task)
+                future.add_done_callback(lambda f, path=task[1]: done(f, path))
 
 
 from omero.gateway import BlitzGateway
 
 if __name__ == "__main__":
-    conn = BlitzGateway(
-        "", "", host="", port="", secure=True
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Transfers Siren annotations to OMERO")
+    parser.add_argument(
+        "parent_dir", nargs="?", default="/workdir/tempdir/Volumes/Siren/Prostate_data"
+    )
+    parser.add_argument("-j", "--workers", type=int, default=0)
+    parser.add_argument(
+        "--prefetch", type=int, default=4, help="slides to look up remote images ahead"
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="decide by registration error and match score, defer borderline slides",
+    )
+    parser.add_argument(
+        "--review", action="store_true", help="work through deferred slides"
+    )
+    parser.add_argument("--review-dir", default="review_queue")
+    parser.add_argument(
+        "--metrics-jsonl", help="append stage timings and queue depths to this file"
+    )
+    parser.add_argument(
+        "--metrics-prom", help="write a Prometheus textfile of the metrics when done"
+    )
+    parser.add_argument(
+        "--journal",
+        default="roi_cloudifier_journal.jsonl",
+        help="record of finished stages, reruns resume from it",
+    )
+    parser.add_argument(
+        "--index",
+        default=DEFAULT_INDEX_PATH,
+        help="sqlite index of the volume, only changed directories are rescanned",
+    )
+    parser.add_argument(
+        "--no-index",
+        dest="index",
+        action="store_const",
+        const=None,
+        help="glob instead",
+    )
+    parser.add_argument(
+        "--thumbnail-cache",
+        default=DEFAULT_THUMBNAIL_CACHE,
+        help="remote thumbnails are kept here until their image changes",
+    )
+    parser.add_argument("--accept-error", type=float, default=0.01)
+    parser.add_argument("--reject-error", type=float, default=0.05)
+    parser.add_argument("--accept-score", type=float, default=0.8)
+    parser.add_argument("--reject-score", type=float, default=0.4)
+    args = parser.parse_args()
+
+    # before any worker starts, so they write to the same file
+    configure(args.metrics_jsonl, collect=bool(args.metrics_prom))
+    conn = connect()
+    thumbnails = ThumbnailProvider(
+        conn, LLabOmeroNamespaceParser.THUMBNAIL_SIZE, args.thumbnail_cache
     )
     try:
-        conn.connect()
-        conn.keepAlive()
         begin = time.time()
-        cloudifier = RoiCloudifier(SirenFileReader(), LLabOmeroNamespaceParser(conn))
-        cloudifier.main("/workdir/tempdir/Volumes/Siren/Prostate_data")
+        cloudifier = RoiCloudifier(
+            SirenFileReader(args.index),
+            LLabOmeroNamespaceParser(conn, thumbnails=thumbnails),
+            workers=args.workers,
+            prefetch_depth=args.prefetch,
+            headless=args.headless,
+            gate=RegistrationGate(
+                args.accept_error,
+                args.reject_error,
+                args.accept_score,
+                args.reject_score,
+            ),
+            review_queue=ReviewQueue(args.review_dir),
+            journal=JobJournal(args.journal),
+        )
+        if args.review:
+            cloudifier.work_review_queue()
+        else:
+            cloudifier.main(args.parent_dir)
+        print(
+            f"{len(cloudifier.succeded)} succeeded, {len(cloudifier.failed)} failed, "
+            f"{len(cloudifier.deferred)} deferred for review, "
+            f"{len(cloudifier.skipped)} already done"
+        )
         print(f"took {time.time() - begin}")
     finally:
+        thumbnails.close()
         conn.close()
+        if args.metrics_prom:
+            writePrometheus(args.metrics_prom)
@@ -0,0 +1,176 @@
+"""
+In-process stand-in for the BlitzGateway calls the scripts make.
+
+Covers getQueryService().projection for findShapesByImages, getRoiService().findByImage,
+getUpdateService().saveArray/saveAndReturnObject and getObject("Image", id). Every call
+can sleep for latency seconds to mimic a round trip to the server.
+"""
+
+import re
+import time
+import itertools
+
+from omero.rtypes import unwrap
+
+from synthetic import makeOmeroRois
+
+
+class FakeServiceOpts(dict):
+    def setOmeroGroup(self, group):
+        self["omero.group"] = str(group)
+
+
+class FakeQueryService:
+    """answers the shape projections of getRois.findShapesByImages"""
+
+    QUERY = re.compile(r"select s\.id, .* from (\w+) s where s\.roi\.image\.id in")
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.calls = 0
+
+    def projection(self, query, params, ctx=None):
+        self.calls += 1
+        time.sleep(self.gateway.latency)
+        match = self.QUERY.match(query)
+        if match is None:
+            raise NotImplementedError(f"FakeQueryService cannot answer: {query}")
+        shape_type = match.group(1)
+        rows = [
+            [row.id, row.image_id, row.stroke_color, *row.geometry]
+            for img_id in unwrap(params.map["ids"])
+            for row in self.gateway.shape_rows.get(img_id, [])
+            if row.type == shape_type
+        ]
+        rows.sort(key=lambda row: row[0])
+        offset = unwrap(params.theFilter.offset) or 0
+        limit = unwrap(params.theFilter.limit)
+        return rows[offset : offset + limit] if limit else rows[offset:]
+
+
+class FakeRoiResult:
+    def __init__(self, rois):
+        self.rois = rois
+
+
+class FakeRoiService:
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def findByImage(self, image_id, options=None, ctx=None):
+        time.sleep(self.gateway.latency)
+        rois = self.gateway.rois.get(image_id)
+        if rois is None:
+            rows = self.gateway.shape_rows.get(image_id, [])
+            rois = self.gateway.rois[image_id] = makeOmeroRois(rows)
+        return FakeRoiResult(rois)
+
+    def close(self):
+        pass
+
+
+class FakeUpdateService:
+    """keeps counts instead of objects, so saving does not grow memory"""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.calls = 0
+        self.saved = 0
+
+    def saveArray(self, objects):
+        self.calls += 1
+        self.saved += len(objects)
+        time.sleep(self.gateway.latency)
+
+    def saveAndReturnObject(self, obj):
+        self.saveArray([obj])
+        return obj
+
+    def close(self):
+        pass
+
+
+class FakeImage:
+    """the ImageWrapper methods the scripts use"""
+
+    def __init__(self, gateway, image_id, name, size_xy, size_c=3):
+        import omero.model
+
+        self._conn = gateway
+        self._obj = omero.model.ImageI(image_id, False)
+        self.id = image_id
+        self.name = name
+        self.size_xy = size_xy
+        self.size_c = size_c
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getSizeX(self):
+        return self.size_xy[0]
+
+    def getSizeY(self):
+        return self.size_xy[1]
+
+    def getSizeC(self):
+        return self.size_c
+
+
+class FakeGateway:
+    """
+    Serves synthetic images and shapes.
+
+    Parameters
+    ----------
+    latency: float, Default: 0
+        Seconds every service call sleeps.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.SERVICE_OPTS = FakeServiceOpts()
+        self.images = {}
+        self.shape_rows = {}
+        self.rois = {}
+        self.query_service = FakeQueryService(self)
+        self.roi_service = FakeRoiService(self)
+        self.update_service = FakeUpdateService(self)
+        self._ids = itertools.count(1)
+
+    def addImage(self, size_xy, shape_rows=(), name=None, size_c=3):
+        """registers an image, shape_rows' image_id is replaced by the new image's id"""
+        image_id = next(self._ids)
+        name = name or f"synthetic_{image_id}.ome.tiff"
+        img = FakeImage(self, image_id, name, size_xy, size_c)
+        self.images[image_id] = img
+        self.shape_rows[image_id] = [
+            row._replace(image_id=image_id) for row in shape_rows
+        ]
+        return img
+
+    def getQueryService(self):
+        return self.query_service
+
+    def getRoiService(self):
+        return self.roi_service
+
+    def getUpdateService(self):
+        return self.update_service
+
+    def getObject(self, obj_type, oid=None, attributes=None):
+        if obj_type.lower() != "image":
+            raise NotImplementedError(f"FakeGateway has no {obj_type} objects")
+        if oid is not None:
+            return self.images.get(int(oid))
+        for img in self.images.values():
+            if all(
+                getattr(img, key, None) == value for key, value in attributes.items()
+            ):
+                return img
+        return None
+
+    def close(self, hard=True):
+        pass
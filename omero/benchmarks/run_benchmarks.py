@@ -0,0 +1,284 @@
+"""
+Offline benchmarks of the ROI hot paths, no OMERO server or Siren volume needed.
+
+Synthetic slides and shapes come from synthetic.py and OMERO calls are answered by
+fake_gateway.FakeGateway. Benchmarks whose script cannot be imported here (ex: valis or
+lavlab missing) are reported as skipped, benchmarks that raise anywhere else as failed.
+
+    python run_benchmarks.py --scale small
+    python run_benchmarks.py --scale medium --save baseline.json
+    python run_benchmarks.py --scale medium --baseline baseline.json  # exits 1 on regression
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STAGE_METRICS_VERBOSE", "0")
+
+from synthetic import (
+    SHAPE_KINDS,
+    makeShapeRows,
+    makeContours,
+    writeAnnotatedRecon,
+    tissueImage,
+)
+
+SCALES = {
+    "small": dict(
+        shapes=200, points=100, slide=(20000, 20000), downsample=10, recon=(2000, 1500)
+    ),
+    "medium": dict(
+        shapes=2000, points=300, slide=(60000, 40000), downsample=10, recon=(4000, 3000)
+    ),
+    "large": dict(
+        shapes=10000,
+        points=1000,
+        slide=(120000, 80000),
+        downsample=10,
+        recon=(8000, 6000),
+    ),
+}
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. It gets the scale dict and a scratch directory and returns
+    (run, items, unit), run is timed and items / seconds is the reported throughput.
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def _slideWithShapes(scale, gateway=None):
+    from fake_gateway import FakeGateway
+
+    gateway = gateway or FakeGateway()
+    # every kind, so rectangles and ellipses go through the converters too
+    rows = makeShapeRows(
+        0, scale["shapes"], scale["points"], scale["slide"], kinds=SHAPE_KINDS
+    )
+    return gateway, gateway.addImage(scale["slide"], rows)
+
+
+@benchmark("getShapesAsPoints")
+def benchShapesAsPoints(scale, workdir):
+    from getRois import getShapesAsPoints
+
+    gateway, img = _slideWithShapes(scale)
+    run = lambda: getShapesAsPoints(img, img_downsample=scale["downsample"])
+    return run, scale["shapes"], "shapes"
+
+
+def _exportMaskBenchmark(mask_format):
+    def setup(scale, workdir):
+        from getRois import exportMask
+
+        gateway, img = _slideWithShapes(scale)
+        rows = gateway.shape_rows[img.getId()]
+        run = lambda: exportMask(
+            img, scale["downsample"], workdir, mask_format=mask_format, shape_rows=rows
+        )
+        mpx = scale["slide"][0] * scale["slide"][1] / scale["downsample"] ** 2 / 1e6
+        return run, mpx, "Mpx"
+
+    return setup
+
+
+for mask_format in ("npy", "labels", "rle"):
+    benchmark(f"exportMask[{mask_format}]")(_exportMaskBenchmark(mask_format))
+
+
+@benchmark("transposeRois")
+def benchTransposeRois(scale, workdir):
+    from transpose_rois import transposeRois
+
+    gateway, img = _slideWithShapes(scale)
+    target = gateway.addImage((scale["slide"][0] // 2, scale["slide"][1] // 2))
+    gateway.getRoiService().findByImage(
+        img.getId()
+    )  # builds the rois outside the timing
+    run = lambda: transposeRois(gateway, img, target)
+    return run, scale["shapes"], "rois"
+
+
+@benchmark("getRoiContours")
+def benchRoiContours(scale, workdir):
+    from RoiCloudifierPar import SirenFileReader
+
+    directory = os.path.join(workdir, "Prostate_data", "1234", "Pathology", "5", "HE")
+    annot_path, _ = writeAnnotatedRecon(
+        directory, scale["recon"], n_regions=scale["shapes"] // 4
+    )
+    reader = SirenFileReader()
+    run = lambda: reader.getRoiContours(annot_path)
+    return run, scale["recon"][0] * scale["recon"][1] / 1e6, "Mpx"
+
+
+@benchmark("buildRemoteRois+saveRemoteRois")
+def benchRemoteRois(scale, workdir):
+    from RoiCloudifierPar import LLabOmeroNamespaceParser
+
+    gateway, img = _slideWithShapes(dict(scale, shapes=0))
+    contours = makeContours(scale["shapes"], scale["points"], scale["recon"])
+    parser = LLabOmeroNamespaceParser(gateway, create_missing=False)
+    details = ("Prostate", "234", ("05", str(scale["downsample"])))
+
+    def run():
+        parser.saveRemoteRois(parser.buildRemoteRois(img, list(contours), details))
+
+    return run, scale["shapes"], "rois"
+
+
+@benchmark("transfer_rois")
+def benchTransferRois(scale, workdir):
+    import RoiCloudifierPar
+    from PIL import Image
+
+    local = tissueImage(scale["recon"], seed=1)
+    # the remote copy is the same tissue moved a little
+    remote = Image.fromarray(local).rotate(3, translate=(40, -25), fillcolor=(255,) * 3)
+    local = Image.fromarray(local)
+    contours = makeContours(scale["shapes"], scale["points"], scale["recon"])
+
+    def run():
+        # a fresh cache every run, so the registration itself is measured
+        RoiCloudifierPar.REGISTRATION_CACHE = tempfile.mkdtemp(dir=workdir)
+        RoiCloudifierPar.ValisLargeReconRoiRegistrar.transfer_rois(
+            list(contours), local, remote
+        )
+
+    return run, scale["shapes"] * scale["points"], "points"
+
+
+def runBenchmark(setup, scale, repeat):
+    """returns {seconds, throughput, unit, peak_mb}, {skipped} or {failed}"""
+    workdir = tempfile.mkdtemp(prefix="roi_bench_")
+    try:
+        try:
+            run, items, unit = setup(scale, workdir)
+        except ImportError as e:
+            return {"skipped": str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            return {"failed": repr(e)}
+        try:
+            return _measure(run, items, unit, repeat)
+        except Exception as e:
+            # an ImportError here is a dependency of the code under test, not missing
+            # tooling, so it fails the benchmark like any other error
+            traceback.print_exc()
+            return {"failed": repr(e)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _measure(run, items, unit, repeat):
+    """times run repeat times and measures its peak memory in one more run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    # tracemalloc slows things down, so memory gets its own run
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    seconds = min(times)
+    return {
+        "seconds": seconds,
+        "throughput": items / seconds,
+        "unit": f"{unit}/s",
+        "peak_mb": peak / 2**20,
+    }
+
+
+def compareToBaseline(results, baseline, tolerance):
+    """
+    returns messages for benchmarks slower or hungrier than baseline by > tolerance,
+    failed, or skipped although the baseline measured them
+    """
+    regressions = []
+    for name, result in results.items():
+        if "failed" in result:
+            regressions.append(f"{name}: failed ({result['failed']})")
+            continue
+        base = baseline.get(name)
+        if base is None or "skipped" in base or "failed" in base:
+            continue
+        if "skipped" in result:
+            regressions.append(f"{name}: skipped ({result['skipped']}), baseline ran")
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['throughput']:.1f} {result['unit']}, "
+                f"baseline {base['throughput']:.1f}"
+            )
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance) + 1:
+            regressions.append(
+                f"{name}: peak {result['peak_mb']:.1f} MB, baseline {base['peak_mb']:.1f}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only", nargs="+", default=[], help="benchmarks whose name contains any"
+    )
+    parser.add_argument("--save", help="write the results as json")
+    parser.add_argument("--baseline", help="json from --save to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed fractional regression"
+    )
+    args = parser.parse_args()
+
+    scale = SCALES[args.scale]
+    results = {}
+    print(f"{'benchmark':<34}{'throughput':>22}{'best s':>10}{'peak MB':>10}")
+    for name, setup in BENCHMARKS.items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        result = results[name] = runBenchmark(setup, scale, args.repeat)
+        if "skipped" in result:
+            print(f"{name:<34}skipped ({result['skipped']})")
+        elif "failed" in result:
+            print(f"{name:<34}FAILED ({result['failed']})")
+        else:
+            throughput = f"{result['throughput']:.1f} {result['unit']}"
+            print(
+                f"{name:<34}{throughput:>22}"
+                f"{result['seconds']:>10.3f}{result['peak_mb']:>10.1f}"
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"scale": args.scale, "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["scale"] != args.scale:
+            parser.error(f"baseline was run at scale {baseline['scale']}")
+        regressions = compareToBaseline(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+    sys.exit(1 if any("failed" in result for result in results.values()) else 0)
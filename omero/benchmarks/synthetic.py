@@ -0,0 +1,154 @@
+"""Synthetic ROI sets and annotated large recons for the benchmarks, all seeded."""
+
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+SHAPE_KINDS = ("Polygon", "Rectangle", "Ellipse")
+
+
+def rgbaToInt(r, g, b, a=255):
+    """inverse of getRois.uint_to_rgba, as the signed 32 bit int OMERO stores"""
+    uint = (r << 24) | (g << 16) | (b << 8) | a
+    return uint - 2**32 if uint >= 2**31 else uint
+
+
+def randomPolygon(rng, center, radius, n_points):
+    """star shaped polygon around center, (n_points, 2) float x,y"""
+    theta = np.sort(rng.uniform(0, 2 * np.pi, n_points))
+    r = radius * rng.uniform(0.5, 1.0, n_points)
+    return np.column_stack(
+        (center[0] + r * np.cos(theta), center[1] + r * np.sin(theta))
+    )
+
+
+def makeShapeRows(
+    image_id,
+    n_shapes,
+    points_per_shape=200,
+    size_xy=(20000, 20000),
+    kinds=SHAPE_KINDS,
+    colors=((0, 255, 0), (255, 0, 0), (0, 0, 255)),
+    seed=0,
+):
+    """
+    Builds findShapesByImages style rows for one image.
+
+    Shapes cycle through kinds and colors, polygons have points_per_shape vertices and
+    every shape stays inside size_xy.
+
+    Returns
+    -------
+    list[getRois.ShapeRow]
+    """
+    from getRois import ShapeRow
+
+    rng = np.random.default_rng(seed)
+    size_xy = np.asarray(size_xy, np.float64)
+    max_radius = size_xy.min() / 20
+    rows = []
+    for i in range(n_shapes):
+        kind = kinds[i % len(kinds)]
+        stroke = rgbaToInt(*colors[i % len(colors)])
+        radius = rng.uniform(max_radius / 4, max_radius)
+        center = rng.uniform(radius, size_xy - radius)
+        if kind == "Polygon":
+            xy = randomPolygon(rng, center, radius, points_per_shape)
+            geometry = [" ".join(f"{x:.2f},{y:.2f}" for x, y in xy)]
+        elif kind == "Rectangle":
+            geometry = [center[0] - radius, center[1] - radius, radius, radius * 1.5]
+        else:
+            geometry = [center[0], center[1], radius, radius * 0.75]
+        rows.append(ShapeRow(i + 1, image_id, kind, stroke, geometry))
+    return rows
+
+
+def makeOmeroRois(shape_rows):
+    """one omero.model.RoiI per shape row, as RoiService.findByImage returns them"""
+    import omero.model
+    from omero.rtypes import rdouble, rint, rstring
+
+    rois = []
+    for row in shape_rows:
+        if row.type == "Polygon":
+            shape = omero.model.PolygonI()
+            shape.setPoints(rstring(row.geometry[0]))
+        elif row.type == "Rectangle":
+            shape = omero.model.RectangleI()
+            for field, value in zip(("X", "Y", "Width", "Height"), row.geometry):
+                getattr(shape, "set" + field)(rdouble(value))
+        else:
+            shape = omero.model.EllipseI()
+            for field, value in zip(("X", "Y", "RadiusX", "RadiusY"), row.geometry):
+                getattr(shape, "set" + field)(rdouble(value))
+        shape.setStrokeColor(rint(row.stroke_color))
+        roi = omero.model.RoiI()
+        roi.addShape(shape)
+        rois.append(roi)
+    return rois
+
+
+def makeContours(n_contours, points_per_contour=200, size_xy=(2000, 2000), seed=0):
+    """(id, rgb, (n, 2) x,y) contours as SirenFileReader.getRoiContours returns them"""
+    rng = np.random.default_rng(seed)
+    size_xy = np.asarray(size_xy, np.float64)
+    max_radius = size_xy.min() / 20
+    rv = []
+    for i in range(n_contours):
+        radius = rng.uniform(max_radius / 4, max_radius)
+        center = rng.uniform(radius, size_xy - radius)
+        rv.append(
+            (i, (0, 255, 0), randomPolygon(rng, center, radius, points_per_contour))
+        )
+    return rv
+
+
+def tissueImage(size_xy, seed=0):
+    """smooth pink blobs on white, enough texture for registration"""
+    rng = np.random.default_rng(seed)
+    w, h = size_xy
+    noise = rng.random((h // 16 + 1, w // 16 + 1)).astype(np.float32)
+    noise = cv2.resize(cv2.GaussianBlur(noise, (0, 0), 2), (w, h))
+    tissue = noise > np.quantile(noise, 0.6)
+    img = np.full((h, w, 3), 255, np.uint8)
+    img[tissue] = (220, 140, 190)
+    shade = (noise[tissue] * 60).astype(np.uint8)[:, None]
+    img[tissue] -= shade
+    return img
+
+
+def writeAnnotatedRecon(
+    directory,
+    size_xy=(4000, 3000),
+    n_regions=50,
+    rgb_vals=((0, 0, 0), (25, 20, 255), (255, 120, 0), (48, 255, 48)),
+    downsample_factor=10,
+    seed=0,
+):
+    """
+    Writes large_recon_<downsample>.tiff and its annotated copy with filled regions.
+
+    directory should follow the Siren layout so SirenFileReader.parse accepts it, ex:
+    <root>/Prostate_data/1234/Pathology/5/HE.
+
+    Returns
+    -------
+    (annotated path, registration path)
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    img = tissueImage(size_xy, seed)
+    reg_path = os.path.join(directory, f"large_recon_{downsample_factor}.tiff")
+    Image.fromarray(img).save(reg_path)
+
+    max_radius = min(size_xy) / 15
+    for i in range(n_regions):
+        radius = rng.uniform(max_radius / 4, max_radius)
+        center = rng.uniform(radius, np.asarray(size_xy) - radius)
+        xy = randomPolygon(rng, center, radius, 32).astype(np.int32)
+        cv2.fillPoly(img, [xy], rgb_vals[i % len(rgb_vals)])
+    annot_path = os.path.join(directory, f"large_recon_{downsample_factor}_ANNOT.tiff")
+    Image.fromarray(img).save(annot_path)
+    return annot_path, reg_path
@@ -0,0 +1,326 @@
+"""
+Matches every annotated large recon of a Siren subtree to an OMERO image at once.
+
+The registration image of every recon is scored against the thumbnail of every candidate
+image, then one global one-to-one assignment picks the pairs, so two recons never claim
+the same image and a close false match cannot win by being looked at first.
+
+    python cohort_matching.py /Volumes/Siren/Prostate_data/1101 -o mapping.csv
+    python cohort_matching.py /Volumes/Siren/Prostate_data --journal roi_cloudifier_journal.jsonl
+"""
+
+import csv
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from image_similarity import DIHEDRAL, SimilarityMatcher, candidateSpectra
+
+MAPPING_FIELDS = (
+    "local_annot_path",
+    "registration_path",
+    "remote_img_id",
+    "remote_name",
+    "score",
+    "margin",
+    "transform",
+    "confident",
+    "reason",
+)
+
+
+def similarityMatrix(local_tns, remote_tns, refine=3, batch_size=256, **matcher_kwargs):
+    """
+    Scores every local thumbnail against the remote ones that could be its match.
+
+    Remote thumbnails are transformed once, each local thumbnail is scored against
+    batch_size of them per FFT product at the coarse size. The refine best entries of
+    every row and every column are then scored again at the fine size, in their best
+    coarse orientation. Only those entries keep a score, all others are -inf, so the
+    assignment and its margins only ever compare fine scores.
+
+    Parameters
+    ----------
+    local_tns: list[PIL.Image.Image]
+        Registration image thumbnails.
+    remote_tns: list[PIL.Image.Image]
+        Candidate OMERO image thumbnails.
+    refine: int, Default: 3
+        Fine scored entries per row and per column.
+    batch_size: int, Default: 256
+        Remote thumbnails per FFT product, bounds memory.
+    matcher_kwargs:
+        Passed to SimilarityMatcher.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        (n_local, n_remote) fine scores, -inf where not refined, and index into the
+        matcher's transforms
+    """
+    scores = np.full((len(local_tns), len(remote_tns)), -np.inf, np.float32)
+    transforms = np.zeros(scores.shape, np.intp)
+    if not len(local_tns) or not len(remote_tns):
+        return scores, transforms
+    matchers = [SimilarityMatcher(tn, **matcher_kwargs) for tn in local_tns]
+    coarse_size, fine_size = matchers[0].coarse_size, matchers[0].fine_size
+    coarse = np.zeros(scores.shape, np.float32)
+    for start in range(0, len(remote_tns), batch_size):
+        batch = remote_tns[start : start + batch_size]
+        spectra = candidateSpectra(batch, coarse_size)
+        for i, matcher in enumerate(matchers):
+            row, best = matcher.coarseScores(None, spectra)
+            coarse[i, start : start + len(batch)] = row
+            transforms[i, start : start + len(batch)] = best
+
+    # every entry the assignment could pick is some row's or column's top refine
+    refined = np.zeros(scores.shape, bool)
+    rows = np.arange(len(local_tns))[:, None]
+    refined[rows, np.argsort(-coarse, axis=1)[:, :refine]] = True
+    cols = np.arange(len(remote_tns))[None, :]
+    refined[np.argsort(-coarse, axis=0)[:refine], cols] = True
+    for j in np.flatnonzero(refined.any(axis=0)):
+        spectrum = candidateSpectra([remote_tns[j]], fine_size)
+        for i in np.flatnonzero(refined[:, j]):
+            scores[i, j] = matchers[i].fineScores(None, [transforms[i, j]], spectrum)[0]
+    return scores, transforms
+
+
+def assign(scores, min_score=0.5):
+    """
+    Solves the one-to-one assignment maximizing the total score.
+
+    Parameters
+    ----------
+    scores: np.ndarray
+        (n_local, n_remote) from similarityMatrix, -inf entries are never assigned.
+    min_score: float, Default: 0.5
+        Assigned pairs scoring lower are dropped.
+
+    Returns
+    -------
+    list[(int, int, float, float)]
+        (row, column, score, margin) of assigned pairs scoring at least min_score. margin
+        is how far the score is above the best competing scored entry of its row or
+        column, the score itself if there is none.
+    """
+    finite = np.isfinite(scores)
+    if not finite.any():
+        return []
+    # linear_sum_assignment needs finite costs, anything below every score will do
+    floor = scores[finite].min() - 1
+    rows, cols = linear_sum_assignment(np.where(finite, scores, floor), maximize=True)
+    rv = []
+    for row, col in zip(rows, cols):
+        score = float(scores[row, col])
+        if not finite[row, col] or score < min_score:
+            continue
+        competing = np.concatenate(
+            (np.delete(scores[row], col), np.delete(scores[:, col], row))
+        )
+        competing = competing[np.isfinite(competing)]
+        margin = score - float(competing.max()) if len(competing) else score
+        rv.append((int(row), int(col), score, margin))
+    return rv
+
+
+def _loadLocal(reader, path):
+    """(registration thumbnail, details, reason), reason says why the others are None"""
+    try:
+        details = reader.parse(path)
+    except AttributeError:
+        return None, None, "does not fit the capture groups"
+    try:
+        with reader.getRegistrationImage(path) as img:
+            return img.convert("RGB").resize(reader.THUMBNAIL_SIZE), details, None
+    except FileNotFoundError:
+        return None, None, "no registration image"
+
+
+def gatherCandidates(parser, details_list, index=None, local_tns=(), index_k=5):
+    """
+    Remote images named like any of the recons, plus the index's best hits when given.
+
+    Returns
+    -------
+    list[omero.gateway.ImageWrapper]
+        unique by id
+    """
+    images = {}
+    for details in dict.fromkeys(details_list):
+        primary = parser._findPrimaryImage(details)
+        for img in parser._findExtendedImages(details) + [primary]:
+            if img is not None:
+                images.setdefault(img.getId(), img)
+    if index is not None:
+        for tn in local_tns:
+            for match in index.search(tn, k=index_k):
+                if match.image_id not in images:
+                    img = parser.conn.getObject("Image", match.image_id)
+                    if img is not None:
+                        images[match.image_id] = img
+    return list(images.values())
+
+
+def matchCohort(
+    reader,
+    parser,
+    root,
+    min_score=0.5,
+    accept_score=0.8,
+    min_margin=0.1,
+    index=None,
+    workers=8,
+):
+    """
+    Matches every annotated recon under root.
+
+    Parameters
+    ----------
+    reader: SirenFileReader
+        Finds, parses and loads the local recons.
+    parser: LLabOmeroNamespaceParser
+        Finds candidate images and fetches their thumbnails.
+    root: str
+        Siren directory to match.
+    min_score: float, Default: 0.5
+        Assigned pairs scoring lower are left unmatched.
+    accept_score, min_margin: float, Default: 0.8, 0.1
+        Pairs scoring at least accept_score and beating every competitor by min_margin
+        are marked confident.
+    index: ThumbnailIndex, optional
+        Adds its best hits per recon to the candidates.
+    workers: int, Default: 8
+        Threads loading local registration images.
+
+    Returns
+    -------
+    list[dict]
+        one row per recon with MAPPING_FIELDS
+    """
+    paths = [item[1] for item in reader.searchDirectory(root) if item is not None]
+    with ThreadPoolExecutor(workers) as executor:
+        loaded = list(executor.map(lambda path: _loadLocal(reader, path), paths))
+
+    rows = {path: dict.fromkeys(MAPPING_FIELDS, "") for path in paths}
+    usable = []
+    for path, (tn, details, reason) in zip(paths, loaded):
+        rows[path]["local_annot_path"] = path
+        if reason is not None:
+            rows[path]["reason"] = reason
+        else:
+            rows[path]["registration_path"] = reader.findRegistrationPath(path) or ""
+            usable.append((path, tn, details))
+
+    local_tns = [tn for _, tn, _ in usable]
+    remote_imgs = gatherCandidates(
+        parser, [details for _, _, details in usable], index, local_tns
+    )
+    print(f"scoring {len(usable)} recons against {len(remote_imgs)} remote images")
+    remote_tns = parser.fetchThumbnails(remote_imgs)
+    scores, transforms = similarityMatrix(local_tns, remote_tns)
+
+    matched = set()
+    for i, j, score, margin in assign(scores, min_score):
+        path = usable[i][0]
+        matched.add(path)
+        rows[path].update(
+            remote_img_id=remote_imgs[j].getId(),
+            remote_name=remote_imgs[j].getName(),
+            score=round(score, 4),
+            margin=round(margin, 4),
+            transform=DIHEDRAL[transforms[i, j]],
+            confident=score >= accept_score and margin >= min_margin,
+        )
+    for path, _, _ in usable:
+        if path not in matched:
+            rows[path]["reason"] = "no remote image scored high enough"
+    return list(rows.values())
+
+
+def writeMapping(path, rows):
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, MAPPING_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def journalMatches(journal, reader, rows):
+    """
+    Records confident matches as matched, RoiCloudifier then skips matching them.
+
+    Returns
+    -------
+    int
+        number of matches recorded
+    """
+    count = 0
+    for row in rows:
+        if row["confident"] is True:
+            path = row["local_annot_path"]
+            journal.record(
+                path,
+                "matched",
+                reader.fingerprint(path),
+                remote_img_id=row["remote_img_id"],
+            )
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from job_journal import JobJournal
+    from siren_index import DEFAULT_INDEX_PATH
+    from RoiCloudifierPar import connect, SirenFileReader, LLabOmeroNamespaceParser
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("root", help="Siren directory to match")
+    parser.add_argument("-o", "--output", default="mapping.csv")
+    parser.add_argument("--min-score", type=float, default=0.5)
+    parser.add_argument("--accept-score", type=float, default=0.8)
+    parser.add_argument("--min-margin", type=float, default=0.1)
+    parser.add_argument(
+        "--journal", help="record confident matches in this RoiCloudifierPar journal"
+    )
+    parser.add_argument(
+        "--thumbnail-index",
+        action="store_true",
+        help="add the ThumbnailIndex's best hits to the candidates",
+    )
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH)
+    parser.add_argument("--no-index", dest="index", action="store_const", const=None)
+    args = parser.parse_args()
+
+    conn = connect()
+    remote_parser = LLabOmeroNamespaceParser(conn)
+    index = None
+    try:
+        if args.thumbnail_index:
+            from thumbnail_index import ThumbnailIndex
+
+            index = ThumbnailIndex()
+            print(f"indexed {index.update(conn)} images")
+        reader = SirenFileReader(args.index)
+        rows = matchCohort(
+            reader,
+            remote_parser,
+            args.root,
+            args.min_score,
+            args.accept_score,
+            args.min_margin,
+            index,
+        )
+        writeMapping(args.output, rows)
+        confident = sum(row["confident"] is True for row in rows)
+        print(f"{confident} of {len(rows)} recons matched confidently -> {args.output}")
+        if args.journal:
+            with JobJournal(args.journal) as journal:
+                print(f"journaled {journalMatches(journal, reader, rows)} matches")
+    finally:
+        if index is not None:
+            index.close()
+        remote_parser.thumbnails.close()
+        conn.close()
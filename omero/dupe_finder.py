@@ -1,15 +1,127 @@
-from omero.gateway import BlitzGateway, ImageWrapper
-from collections import Counter
-import re
-conn = BlitzGateway('','', host= 'wss://wsi.lavlab.mcw.edu/omero-wss', secure= True)
-conn.connect()
-conn.SERVICE_OPTS.setOmeroGroup(-1)
-
-#Dupe finder
-#Used to remove dupes before renaming 
-name_list = []
-for x in conn.getObjects('image'):
-    name_list.append(x.getName())
-element_count = Counter(name_list)
-duplicates = [element for element, count in element_count.items() if count > 1]
-print("Duplicates in the list are:", duplicates)
\ No newline at end of file
+from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
+import sqlite3
+import sys
+
+# Dupe finder
+# Used to remove dupes before renaming
+# Keeps a local sqlite index, each run lists every image but only re-reads the ones that
+# are new or changed since the last one and drops the ones that are gone
+
+INDEX_PATH = "dupe_index.sqlite"
+PAGE_SIZE = 5000
+
+IMAGES_QUERY = (
+    "select i.id, i.name, i.details.group.id, fs.id, i.details.updateEvent.id "
+    "from Image i left outer join i.fileset fs order by i.id"
+)
+FILE_HASHES_QUERY = (
+    "select i.id, f.hash from Image i join i.fileset fs join fs.usedFiles fe "
+    "join fe.originalFile f where i.id in (:ids)"
+)
+
+
+def openIndex(path=INDEX_PATH):
+    index = sqlite3.connect(path)
+    index.executescript(
+        """
+        create table if not exists images (
+            id integer primary key, name text, group_id integer,
+            fileset_id integer, content_hash text, update_event integer
+        );
+        create index if not exists images_name on images (name);
+        create index if not exists images_hash on images (content_hash);
+        """
+    )
+    columns = [column[1] for column in index.execute("pragma table_info(images)")]
+    if "update_event" not in columns:
+        # indexes from before update events were kept, every row is refreshed once
+        index.execute("alter table images add column update_event integer")
+        index.commit()
+    return index
+
+
+def pageImages(conn, page_size=PAGE_SIZE):
+    """yields pages of (id, name, group id, fileset id, update event id) of every image"""
+    query_service = conn.getQueryService()
+    params = ParametersI()
+    offset = 0
+    while True:
+        params.page(offset, page_size)
+        rows = [unwrap(row) for row in query_service.projection(
+            IMAGES_QUERY, params, conn.SERVICE_OPTS)]
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+def fetchContentHashes(conn, image_ids):
+    """one hash per image made from all of its fileset's original file hashes"""
+    params = ParametersI()
+    params.addIds(image_ids)
+    hashes = {}
+    for img_id, file_hash in map(unwrap, conn.getQueryService().projection(
+            FILE_HASHES_QUERY, params, conn.SERVICE_OPTS)):
+        if file_hash:
+            hashes.setdefault(img_id, []).append(file_hash)
+    return {img_id: ":".join(sorted(h)) for img_id, h in hashes.items()}
+
+
+def updateIndex(conn, index, with_hashes=True):
+    """
+    brings the index in line with the server, images that are new or whose update event
+    changed (ex: renamed) are re-read and deleted images are dropped.
+    returns (images added or refreshed, images removed)
+    """
+    stored = dict(index.execute("select id, update_event from images"))
+    present = set()
+    updated = 0
+    for rows in pageImages(conn):
+        present.update(row[0] for row in rows)
+        changed = [row for row in rows if row[0] not in stored or stored[row[0]] != row[4]]
+        if not changed:
+            continue
+        hashes = fetchContentHashes(conn, [row[0] for row in changed]) if with_hashes else {}
+        index.executemany(
+            "insert or replace into images "
+            "(id, name, group_id, fileset_id, update_event, content_hash) "
+            "values (?, ?, ?, ?, ?, ?)",
+            [(*row, hashes.get(row[0])) for row in changed],
+        )
+        index.commit()
+        updated += len(changed)
+    removed = [(img_id,) for img_id in stored if img_id not in present]
+    index.executemany("delete from images where id = ?", removed)
+    index.commit()
+    return updated, len(removed)
+
+
+def findNameDuplicates(index):
+    return [name for name, in index.execute(
+        "select name from images group by name having count(*) > 1")]
+
+
+def findContentDuplicates(index):
+    """image ids sharing original file hashes across different filesets"""
+    groups = index.execute(
+        "select group_concat(id) from images where content_hash is not null "
+        "group by content_hash having count(distinct fileset_id) > 1")
+    return [[int(img_id) for img_id in ids.split(",")] for ids, in groups]
+
+
+if __name__ == "__main__":
+    conn = BlitzGateway('', '', host='wss://wsi.lavlab.mcw.edu/omero-wss', secure=True)
+    conn.connect()
+    conn.SERVICE_OPTS.setOmeroGroup(-1)
+    index = openIndex(sys.argv[1] if len(sys.argv) > 1 else INDEX_PATH)
+    try:
+        updated, removed = updateIndex(conn, index)
+        print(f"Indexed {updated} new or changed images, dropped {removed} deleted ones")
+        print("Duplicates in the list are:", findNameDuplicates(index))
+        print("Content duplicates are:", findContentDuplicates(index))
+    finally:
+        index.close()
+        conn.close()
@@ -1,37 +1,140 @@
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from omero.gateway import BlitzGateway
 from contextlib import redirect_stdout, contextmanager
+import cv2
 import numpy as np
-from lavlab.omero_util import getDownsampledXYDimensions, getImageAtResolution
+from lavlab.omero_util import getDownsampledXYDimensions
+from recon_cache import LargeReconCache
 
-def getLargeRecon(img, downsample_factor:int = 10):
+PIXEL_TYPES = {"float": "float32", "double": "float64", "bit": "uint8"}
+"""omero pixel types whose names are not numpy dtypes"""
+
+def getLargeRecon(img, downsample_factor:int = 10, workers:int = 4, cache:LargeReconCache = None):
     """
 Checks OMERO for a pregenerated large recon, if none are found, it will generate and upload one.
 
+Reads the closest pyramid level tile by tile over a small pool of sessions, then only that
+level is resampled to the requested size.
+
 Parameters
 ----------
 img: omero.gateway.ImageWrapper
     Omero Image object from conn.getObjects().
 downsample_factor: int, Default: 10
     Which large recon size to get.
+workers: int, Default: 4
+    How many tiles to fetch at once, each worker gets its own session connection.
+cache: LargeReconCache, optional
+    Reuses a previously read recon of the same pixel data and downsample.
 
 Returns
 -------
-omero.gateway.AnnotationWrapper
-    remote large recon object
-str
-    local path to large recon
+np.ndarray
+    (y, x, c) large recon, (y, x) for single channel images
     """
-    sizeX = img.getSizeX()
-    sizeY = img.getSizeY()
-    xy_dim = getDownsampledXYDimensions(img, downsample_factor)
-    recon_img = getImageAtResolution(img, xy_dim)
-    recon_array = np.array(recon_img)
-
+    if cache is not None:
+        return cache.getOrCreate(img, downsample_factor,
+                                 lambda: getLargeRecon(img, downsample_factor, workers))
+    xy_dim = tuple(int(v) for v in getDownsampledXYDimensions(img, downsample_factor))
+    level, level_xy = getClosestResolutionLevel(img, xy_dim)
+    recon_array = readResolutionLevel(img, level, level_xy, workers)
+    if (recon_array.shape[1], recon_array.shape[0]) != xy_dim:
+        recon_array = cv2.resize(recon_array, xy_dim, interpolation=cv2.INTER_AREA)
+    if recon_array.ndim == 3 and recon_array.shape[2] == 1:
+        recon_array = recon_array[..., 0]
     return recon_array
 
 
+def _groupContext(img):
+    return {"omero.group": str(img.getDetails().getGroup().getId())}
+
+
+def getClosestResolutionLevel(img, xy_dim):
+    """
+Finds the smallest pyramid level that is at least xy_dim in both axes.
+
+Returns
+-------
+int
+    level for RawPixelsStore.setResolutionLevel (0 is the smallest level)
+tuple(int, int)
+    (x, y) size of that level
+    """
+    rps = img._conn.c.sf.createRawPixelsStore()
+    try:
+        rps.setPixelsId(img.getPrimaryPixels().getId(), True, _groupContext(img))
+        # descriptions run from full resolution down, levels run the other way
+        descriptions = [(d.sizeX, d.sizeY) for d in rps.getResolutionDescriptions()]
+    finally:
+        rps.close()
+    for i in reversed(range(len(descriptions))):
+        size_x, size_y = descriptions[i]
+        if size_x >= xy_dim[0] and size_y >= xy_dim[1]:
+            return len(descriptions) - 1 - i, (size_x, size_y)
+    return len(descriptions) - 1, descriptions[0]
+
+
+def readResolutionLevel(img, level, level_xy, workers=4):
+    """
+Reads a whole pyramid level with concurrent getTile calls.
+
+Every worker thread joins the image's session on its own connection and keeps one
+RawPixelsStore, tiles are written straight into one preallocated (y, x, c) array.
+    """
+    conn = img._conn
+    pixels_id = img.getPrimaryPixels().getId()
+    size_c = img.getSizeC()
+    pixel_type = np.dtype(PIXEL_TYPES.get(img.getPixelsType(), img.getPixelsType()))
+    wire_type = pixel_type.newbyteorder(">")  # omero sends tiles big endian
+    out = np.empty((level_xy[1], level_xy[0], size_c), pixel_type)
+
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def store():
+        if not hasattr(local, "rps"):
+            worker_conn = conn.clone()
+            worker_conn.connect(sUuid=conn.c.getSessionId())
+            rps = worker_conn.c.sf.createRawPixelsStore()
+            rps.setPixelsId(pixels_id, True, _groupContext(img))
+            rps.setResolutionLevel(level)
+            local.rps = rps
+            with opened_lock:
+                opened.append((worker_conn, rps))
+        return local.rps
+
+    def read(tile):
+        c, x, y, w, h = tile
+        data = store().getTile(0, c, 0, x, y, w, h)
+        out[y:y + h, x:x + w, c] = np.frombuffer(data, wire_type).reshape(h, w)
+
+    rps = conn.c.sf.createRawPixelsStore()
+    try:
+        rps.setPixelsId(pixels_id, True, _groupContext(img))
+        rps.setResolutionLevel(level)
+        tile_w, tile_h = rps.getTileSize()
+    finally:
+        rps.close()
+
+    tiles = [(c, x, y, min(tile_w, level_xy[0] - x), min(tile_h, level_xy[1] - y))
+             for c in range(size_c)
+             for y in range(0, level_xy[1], tile_h)
+             for x in range(0, level_xy[0], tile_w)]
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            # list() surfaces the first failed tile
+            list(pool.map(read, tiles))
+    finally:
+        for worker_conn, rps in opened:
+            rps.close()
+            worker_conn.close(hard=False)  # the session is shared, do not kill it
+    return out
+
+
 @contextmanager
 def suppress():
     with open(os.devnull, "w") as null:
@@ -64,15 +167,16 @@ def read_credentials(filename):
     
     return username, password
 
-img_id = sys.argv[1]
-downsample_factor=10
-if len(sys.argv) > 2:
-    downsample_factor = int(sys.argv[2])
-
-conn = BlitzGateway('', '', host='lavlab.mcw.edu', secure=True)
-print(conn.connect())
-conn.SERVICE_OPTS.setOmeroGroup("-1")
-img = conn.getObject('image', img_id)
-print(img)
-y = getLargeRecon(img, downsample_factor)
-conn.close()
+if __name__ == "__main__":
+    img_id = sys.argv[1]
+    downsample_factor=10
+    if len(sys.argv) > 2:
+        downsample_factor = int(sys.argv[2])
+
+    conn = BlitzGateway('', '', host='lavlab.mcw.edu', secure=True)
+    print(conn.connect())
+    conn.SERVICE_OPTS.setOmeroGroup("-1")
+    img = conn.getObject('image', img_id)
+    print(img)
+    y = getLargeRecon(img, downsample_factor, cache=LargeReconCache())
+    conn.close()
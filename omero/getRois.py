@@ -1,5 +1,10 @@
 import os
 import sys
+import time
+import traceback
+from multiprocessing import get_context
+from multiprocessing.util import Finalize
+from collections import namedtuple
 from contextlib import redirect_stdout, contextmanager
 
 
@@ -17,13 +22,12 @@ with suppress():
     import cv2
     import numpy as np
     from PIL import Image
-    from skimage import draw
 
     from omero.gateway import BlitzGateway
-    from omero_model_PolygonI import PolygonI
-    from omero_model_EllipseI import EllipseI
-    from omero_model_PolygonI import PolygonI
-    from omero_model_RectangleI import RectangleI
+    from omero.rtypes import unwrap
+    from omero.sys import ParametersI
+
+    from stage_metrics import span, configure, writePrometheus
 
 
 def uint_to_rgba(uint: int) -> int:
@@ -109,12 +113,341 @@ def getRois(img, roi_service=None):
     return rois
 
 
+ShapeRow = namedtuple(
+    "ShapeRow", ("id", "image_id", "type", "stroke_color", "geometry")
+)
+"""A projected shape, geometry is (points,) for polygons, (x, y, width, height) for
+rectangles and (x, y, radiusX, radiusY) for ellipses."""
+
+SHAPE_GEOMETRY_FIELDS = {
+    "Polygon": ("points",),
+    "Rectangle": ("x", "y", "width", "height"),
+    "Ellipse": ("x", "y", "radiusX", "radiusY"),
+}
+
+
+@span("findShapesByImages")
+def findShapesByImages(
+    conn,
+    image_ids,
+    shape_types=tuple(SHAPE_GEOMETRY_FIELDS),
+    page_size=10000,
+    image_chunk=1000,
+):
+    """
+    Gathers the shapes of many images with a few paginated projection queries.
+
+    Only the shape id, image id, stroke color and geometry are loaded, so this is much
+    lighter than getRois when only geometry is needed.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway
+        Connected gateway, its SERVICE_OPTS are used as the call context.
+    image_ids: list[int]
+        Images to gather shapes from.
+    shape_types: tuple[str], Default: all of SHAPE_GEOMETRY_FIELDS
+        Which shape classes to query, one query per type, image chunk and page.
+    page_size: int, Default: 10000
+        Rows per query.
+    image_chunk: int, Default: 1000
+        Most image ids put in a single query's IN clause.
+
+    Returns
+    -------
+    dict[int, list[ShapeRow]]
+        shapes per image id, sorted by shape id. Images without shapes map to an empty list.
+    """
+    image_ids = list(dict.fromkeys(int(img_id) for img_id in image_ids))
+    rv = {img_id: [] for img_id in image_ids}
+    query_service = conn.getQueryService()
+    for shape_type in shape_types:
+        fields = ", ".join("s." + field for field in SHAPE_GEOMETRY_FIELDS[shape_type])
+        query = (
+            f"select s.id, s.roi.image.id, s.strokeColor, {fields} "
+            f"from {shape_type} s where s.roi.image.id in (:ids) order by s.id"
+        )
+        for i in range(0, len(image_ids), image_chunk):
+            params = ParametersI()
+            params.addIds(image_ids[i : i + image_chunk])
+            offset = 0
+            while True:
+                params.page(offset, page_size)
+                rows = query_service.projection(query, params, conn.SERVICE_OPTS)
+                for row in rows:
+                    shape_id, img_id, stroke_color, *geometry = unwrap(row)
+                    rv[img_id].append(
+                        ShapeRow(shape_id, img_id, shape_type, stroke_color, geometry)
+                    )
+                if len(rows) < page_size:
+                    break
+                offset += page_size
+    for shapes in rv.values():
+        shapes.sort()
+    return rv
+
+
+class ShapeCoordinates:
+    """
+    Every shape on an image packed into flat coordinate arrays.
+
+    Shape i owns the rows xy[offsets[i]:offsets[i+1]]. Iterating or indexing yields
+    (shape.id, (r,g,b), xy) tuples where xy is a (n, 2) view, so it can be passed
+    anywhere the output of getShapesAsPoints is accepted.
+
+    Attributes
+    ----------
+    ids: np.ndarray
+        (shapes,) int64 shape ids, sorted ascending.
+    rgbs: np.ndarray
+        (shapes, 3) uint8 stroke colors.
+    xy: np.ndarray
+        (points, 2) float64 x,y coordinates of all shapes back to back.
+    offsets: np.ndarray
+        (shapes + 1,) int64 start of each shape in xy, ending with len(xy).
+    kinds: np.ndarray, optional
+        (shapes,) shape type names ("Polygon", "Rectangle" or "Ellipse").
+    primitives: np.ndarray, optional
+        (shapes, 4) float64 scaled (x, y, width, height) of rectangles and
+        (x, y, radiusX, radiusY) of ellipses, NaN for polygons.
+    """
+
+    def __init__(self, ids, rgbs, xy, offsets, kinds=None, primitives=None):
+        self.ids = ids
+        self.rgbs = rgbs
+        self.xy = xy
+        self.offsets = offsets
+        self.kinds = kinds
+        self.primitives = primitives
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return (
+            int(self.ids[i]),
+            tuple(int(v) for v in self.rgbs[i]),
+            self.xy[self.offsets[i] : self.offsets[i + 1]],
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def asPoints(self):
+        """
+        Returns the getShapesAsPoints view of these shapes.
+
+        Returns
+        -------
+        list[ shape.id, (r,g,b), list[tuple(x,y)] ]
+        """
+        return [(id, rgb, list(map(tuple, xy.tolist()))) for id, rgb, xy in self]
+
+
+def parsePointStrings(point_strings, img_downsample=1, point_downsample=1):
+    """
+    Parses many OMERO polygon point strings in one pass.
+
+    Parameters
+    ----------
+    point_strings: list[str]
+        Polygon point strings, ex: "x1,y1 x2,y2 ..."
+    img_downsample: int, Default: 1
+        How much to scale points.
+    point_downsample: int, Default: 1
+        Keeps every nth point of each polygon.
+
+    Returns
+    -------
+    np.ndarray
+        (points, 2) float64 x,y coordinates of every polygon back to back.
+    np.ndarray
+        (polygons + 1,) int64 start of each polygon in the coordinate array.
+    """
+    counts = np.fromiter(
+        (string.count(",") for string in point_strings), np.int64, len(point_strings)
+    )
+    xy = np.fromstring(" ".join(point_strings).replace(",", " "), sep=" ")
+    xy = xy.reshape(-1, 2)
+    starts = np.cumsum(counts) - counts
+
+    if point_downsample > 1:
+        # position of every point within its own polygon
+        local = np.arange(len(xy)) - np.repeat(starts, counts)
+        xy = xy[local % point_downsample == 0]
+        counts = (counts + point_downsample - 1) // point_downsample
+
+    if img_downsample != 1:
+        xy /= img_downsample
+    offsets = np.zeros(len(counts) + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return xy, offsets
+
+
+def rectangleOutlines(primitives):
+    """
+    Corners of many rectangles at once.
+
+    Parameters
+    ----------
+    primitives: np.ndarray
+        (rectangles, 4) x, y, width, height.
+
+    Returns
+    -------
+    np.ndarray
+        (rectangles * 4, 2) float64 x,y corners, clockwise from the top left
+    np.ndarray
+        (rectangles + 1,) int64 start of each rectangle in the corners
+    """
+    x, y, w, h = np.asarray(primitives, np.float64).reshape(-1, 4).T
+    corners = np.stack(
+        (
+            np.column_stack((x, y)),
+            np.column_stack((x + w, y)),
+            np.column_stack((x + w, y + h)),
+            np.column_stack((x, y + h)),
+        ),
+        axis=1,
+    )
+    return corners.reshape(-1, 2), np.arange(len(x) + 1, dtype=np.int64) * 4
+
+
+def ellipseOutlines(primitives, point_downsample=1):
+    """
+    Perimeter points of many ellipses at once.
+
+    Every ellipse gets about one point per pixel of its longer circumference, divided
+    by point_downsample, and at least 8.
+
+    Parameters
+    ----------
+    primitives: np.ndarray
+        (ellipses, 4) center x, center y, radiusX, radiusY.
+    point_downsample: int, Default: 1
+        Keeps about every nth point.
+
+    Returns
+    -------
+    np.ndarray
+        (points, 2) float64 x,y coordinates of every ellipse back to back
+    np.ndarray
+        (ellipses + 1,) int64 start of each ellipse in the coordinates
+    """
+    cx, cy, rx, ry = np.asarray(primitives, np.float64).reshape(-1, 4).T
+    radius = np.maximum(np.abs(rx), np.abs(ry))
+    counts = np.maximum(np.ceil(2 * np.pi * radius / point_downsample), 8)
+    counts = counts.astype(np.int64)
+    offsets = np.zeros(len(counts) + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    owner = np.repeat(np.arange(len(counts)), counts)
+    # position of every point within its own ellipse
+    theta = 2 * np.pi * (np.arange(offsets[-1]) - offsets[owner]) / counts[owner]
+    xy = np.column_stack(
+        (cx[owner] + rx[owner] * np.cos(theta), cy[owner] + ry[owner] * np.sin(theta))
+    )
+    return xy, offsets
+
+
+@span("getShapeCoordinates")
+def getShapeCoordinates(
+    img,
+    point_downsample=4,
+    img_downsample=1,
+    roi_service=None,
+    shape_rows=None,
+    outlines=True,
+) -> ShapeCoordinates:
+    """
+    Gathers Rectangles, Polygons, and Ellipses into a ShapeCoordinates.
+
+    Polygon point strings are parsed together with parsePointStrings, rectangles become
+    their corners with rectangleOutlines and ellipses their perimeter points with
+    ellipseOutlines.
+
+    Parameters
+    ----------
+    img: omero.gateway.ImageWrapper
+        Omero Image object from conn.getObjects().
+    point_downsample: int, Default: 4
+        Grabs every nth point for faster computation.
+    img_downsample: int, Default: 1
+        How much to scale roi points.
+    roi_service: omero.RoiService, optional
+        Unused, shapes are gathered with findShapesByImages. Kept for compatibility.
+    shape_rows: list[ShapeRow], optional
+        This image's entry from a findShapesByImages call covering many images.
+    outlines: bool, Default: True
+        False leaves the xy of rectangles and ellipses empty, for consumers like
+        iterLabelTiles that draw them from primitives.
+
+    Returns
+    -------
+    ShapeCoordinates
+        shapes sorted by id, None if the image has no supported shapes
+    """
+    if shape_rows is None:
+        shape_rows = findShapesByImages(img._conn, [img.getId()])[img.getId()]
+
+    # (id, rgb, xy or None, kind, primitive), xy is filled in per kind afterwards
+    entries = []
+    by_kind = {"Polygon": [], "Rectangle": [], "Ellipse": []}
+    for row in shape_rows:
+        if row.type not in by_kind:
+            continue
+        rgb = uint_to_rgba(row.stroke_color or 0)[:-1]  # ignore alpha value
+        by_kind[row.type].append((len(entries), row.geometry))
+        if row.type == "Polygon":
+            primitive = (np.nan,) * 4
+        else:
+            primitive = tuple(float(v) / img_downsample for v in row.geometry)
+        entries.append((row.id, rgb, None, row.type, primitive))
+
+    if not entries:  # if no shapes return none
+        return None
+
+    for kind, members in by_kind.items():
+        if not members:
+            continue
+        if kind == "Polygon":
+            kind_xy, kind_offsets = parsePointStrings(
+                [geometry[0] for _, geometry in members],
+                img_downsample,
+                point_downsample,
+            )
+        elif not outlines:
+            kind_xy = np.empty((0, 2), np.float64)
+            kind_offsets = np.zeros(len(members) + 1, np.int64)
+        else:
+            primitives = [entries[i][4] for i, _ in members]
+            if kind == "Rectangle":
+                kind_xy, kind_offsets = rectangleOutlines(primitives)
+            else:
+                kind_xy, kind_offsets = ellipseOutlines(primitives, point_downsample)
+        for (i, _), start, end in zip(members, kind_offsets[:-1], kind_offsets[1:]):
+            entries[i] = entries[i][:2] + (kind_xy[start:end],) + entries[i][3:]
+
+    # make sure is in correct order
+    entries.sort(key=lambda entry: entry[0])
+    ids = np.array([entry[0] for entry in entries], np.int64)
+    rgbs = np.array([entry[1] for entry in entries], np.uint8).reshape(-1, 3)
+    offsets = np.zeros(len(entries) + 1, np.int64)
+    np.cumsum([len(entry[2]) for entry in entries], out=offsets[1:])
+    xy = np.concatenate([entry[2] for entry in entries]).reshape(-1, 2)
+    kinds = np.array([entry[3] for entry in entries])
+    primitives = np.array([entry[4] for entry in entries], np.float64)
+    return ShapeCoordinates(ids, rgbs, xy, offsets, kinds, primitives)
+
+
 def getShapesAsPoints(
     img, point_downsample=4, img_downsample=1, roi_service=None
 ) -> list[tuple[int, tuple[int, int, int], list[tuple[float, float]]]]:
     """
     Gathers Rectangles, Polygons, and Ellipses as a tuple containing the shapeId, its rgb val, and a tuple of yx points of its bounds.
 
+    List view of getShapeCoordinates, prefer that for large annotations.
+
     Parameters
     ----------
     img: omero.gateway.ImageWrapper
@@ -124,138 +457,584 @@ def getShapesAsPoints(
     img_downsample: int, Default: 1
         How much to scale roi points.
     roi_service: omero.RoiService, optional
-        Allows roiservice passthrough for performance.
+        Unused, kept for compatibility.
 
     Returns
     -------
     returns: list[ shape.id, (r,g,b), list[tuple(x,y)] ]
         list of tuples containing a shape's id, rgb value, and a tuple of row and column points
     """
-
-    sizeX = img.getSizeX() / img_downsample
-    sizeY = img.getSizeY() / img_downsample
-    yx_shape = (sizeY, sizeX)
-
-    shapes = []
-    for roi in getRois(img, roi_service):
-        points = None
-        for shape in roi.copyShapes():
-            if type(shape) == RectangleI:
-                x = float(shape.getX().getValue()) / img_downsample
-                y = float(shape.getY().getValue()) / img_downsample
-                w = float(shape.getWidth().getValue()) / img_downsample
-                h = float(shape.getHeight().getValue()) / img_downsample
-                # points = [(x, y),(x+w, y), (x+w, y+h), (x, y+h), (x, y)]
-                points = draw.rectangle_perimeter(
-                    (y, x), (y + h, x + w), shape=yx_shape
-                )
-                points = [
-                    (points[1][i], points[0][i]) for i in range(0, len(points[0]))
-                ]
-
-            if type(shape) == EllipseI:
-                points = draw.ellipse_perimeter(
-                    float(shape._y._val / img_downsample),
-                    float(shape._x._val / img_downsample),
-                    float(shape._radiusY._val / img_downsample),
-                    float(shape._radiusX._val / img_downsample),
-                    shape=yx_shape,
-                )
-                points = [
-                    (points[1][i], points[0][i]) for i in range(0, len(points[0]))
-                ]
-
-            if type(shape) == PolygonI:
-                pointStrArr = shape.getPoints()._val.split(" ")
-                points = parsePolygonPointString(pointStrArr, img_downsample)
-            if points is not None:
-                color_val = shape.getStrokeColor()._val
-                rgb = uint_to_rgba(color_val)[:-1]  # ignore alpha value for computation
-                points = points[::point_downsample]
-
-                shapes.append((shape.getId()._val, rgb, points))
-
-    if not shapes:  # if no shapes in shapes return none
+    shapes = getShapeCoordinates(img, point_downsample, img_downsample, roi_service)
+    if shapes is None:  # if no shapes in shapes return none
         return None
-
-    # make sure is in correct order
-    return sorted(shapes)
+    return shapes.asPoints()
 
 
 def parsePolygonPointString(polyString, img_downsample=1):
-    xy = []
-    for i in range(0, len(polyString)):
-        coordList = polyString[i].split(",")
-        xy.append(
-            (float(coordList[0]) / img_downsample, float(coordList[1]) / img_downsample)
+    xy, _ = parsePointStrings(polyString, img_downsample)
+    return list(map(tuple, xy.tolist())) or None
+
+
+def _shapeBounds(shapes, i):
+    """(x_min, y_min, x_max, y_max) of shape i, from its primitive if it has no points"""
+    xy = np.asarray(shapes[i][2], np.int32).reshape(-1, 2)
+    if xy.size:
+        return (*xy.min(axis=0), *xy.max(axis=0))
+    kind = shapes.kinds[i] if getattr(shapes, "kinds", None) is not None else None
+    if kind == "Rectangle":
+        x, y, w, h = shapes.primitives[i]
+        return x, y, x + w, y + h
+    if kind == "Ellipse":
+        x, y, rx, ry = shapes.primitives[i]
+        return x - abs(rx), y - abs(ry), x + abs(rx), y + abs(ry)
+    return None
+
+
+def binShapesByTile(shapes, out_shape, tile_size=4096):
+    """
+    Bins shapes by the tiles their bounding boxes overlap.
+
+    Parameters
+    ----------
+    shapes: list[ shape.id, (r,g,b), list[tuple(x,y)] ]
+        Output of getShapeCoordinates or getShapesAsPoints. Rectangles and ellipses
+        without points are binned by their primitives.
+    out_shape: tuple[int, int]
+        (rows, columns) of the mask being rasterized.
+    tile_size: int, Default: 4096
+        Edge length of a square tile in mask pixels.
+
+    Returns
+    -------
+    dict[tuple(tile_row, tile_col), list[int]]
+        Indices into shapes, in their original order, for every tile that has at least one shape.
+    """
+    n_rows = -(-out_shape[0] // tile_size)
+    n_cols = -(-out_shape[1] // tile_size)
+    bins = {}
+    for i in range(len(shapes)):
+        bounds = _shapeBounds(shapes, i)
+        if bounds is None:
+            continue
+        x_min, y_min, x_max, y_max = bounds
+        # clip to the mask, shapes hanging off the slide edge still touch edge tiles
+        col_lo = max(int(x_min) // tile_size, 0)
+        col_hi = min(int(x_max) // tile_size, n_cols - 1)
+        row_lo = max(int(y_min) // tile_size, 0)
+        row_hi = min(int(y_max) // tile_size, n_rows - 1)
+        for tile_row in range(row_lo, row_hi + 1):
+            for tile_col in range(col_lo, col_hi + 1):
+                bins.setdefault((tile_row, tile_col), []).append(i)
+    return bins
+
+
+@span("rasterizeShapesTiled")
+def rasterizeShapesTiled(shapes, out, tile_size=4096, background=255, margin=64):
+    """
+    Fills shapes into out one tile at a time.
+
+    Peak memory is a single (tile_size + 2 * margin) square buffer, so out can be a
+    np.memmap or any chunked array that supports slice assignment. OpenCV clips
+    polygons reaching past the buffer and the clipped edges can move by a few pixels,
+    far from the border too. Each tile is filled with margin extra pixels on every
+    side and cropped, so only shapes reaching more than margin past a tile can differ
+    from a whole image fillPoly, the result is not guaranteed to match it exactly.
+
+    Parameters
+    ----------
+    shapes: list[ shape.id, (r,g,b), list[tuple(x,y)] ]
+        Output of getShapeCoordinates or getShapesAsPoints. Later shapes are drawn over earlier ones.
+    out: array-like
+        (rows, columns, channels) uint8 destination.
+    tile_size: int, Default: 4096
+        Edge length of a square tile in mask pixels.
+    background: int, Default: 255
+        Value for pixels not covered by any shape.
+    margin: int, Default: 64
+        Pixels filled around every tile and thrown away.
+
+    Returns
+    -------
+    array-like
+        out
+    """
+    rows, cols = out.shape[:2]
+    bins = binShapesByTile(shapes, (rows, cols), tile_size)
+    # convert once, tiles only need an integer offset
+    polys = [np.asarray(xy, np.int32).reshape(-1, 1, 2) for _, _, xy in shapes]
+    for y0 in range(0, rows, tile_size):
+        for x0 in range(0, cols, tile_size):
+            y1 = min(y0 + tile_size, rows)
+            x1 = min(x0 + tile_size, cols)
+            tile = np.full(
+                (y1 - y0 + 2 * margin, x1 - x0 + 2 * margin) + out.shape[2:],
+                background,
+                out.dtype,
+            )
+            offset = np.array((x0 - margin, y0 - margin), np.int32)
+            for i in bins.get((y0 // tile_size, x0 // tile_size), ()):
+                cv2.fillPoly(tile, [polys[i] - offset], color=shapes[i][1])
+            out[y0:y1, x0:x1] = tile[
+                margin : margin + y1 - y0, margin : margin + x1 - x0
+            ]
+    if hasattr(out, "flush"):
+        out.flush()
+    return out
+
+
+LABEL_LUT_HEADER = "label,shape_id,r,g,b"
+"""columns of the color lookup table written next to label maps"""
+
+ELLIPSE_SHIFT = 4
+"""fractional bits used to draw ellipses with sub pixel centers and axes"""
+
+
+def _fillLabel(tile, shapes, i, offset):
+    """draws shape i into tile as label i+1, natively for rectangles and ellipses"""
+    label = i + 1
+    kind = shapes.kinds[i] if getattr(shapes, "kinds", None) is not None else None
+    if kind == "Rectangle":
+        x, y, w, h = shapes.primitives[i]
+        top_left = (int(round(x)) - offset[0], int(round(y)) - offset[1])
+        bottom_right = (int(round(x + w)) - offset[0], int(round(y + h)) - offset[1])
+        cv2.rectangle(tile, top_left, bottom_right, label, thickness=-1)
+    elif kind == "Ellipse":
+        x, y, rx, ry = shapes.primitives[i]
+        scale = 1 << ELLIPSE_SHIFT
+        center = (
+            int(round((x - offset[0]) * scale)),
+            int(round((y - offset[1]) * scale)),
+        )
+        axes = (int(round(rx * scale)), int(round(ry * scale)))
+        cv2.ellipse(tile, center, axes, 0, 0, 360, label, -1, shift=ELLIPSE_SHIFT)
+    else:
+        xy = np.asarray(shapes[i][2], np.int32).reshape(-1, 1, 2)
+        cv2.fillPoly(tile, [xy - np.array(offset, np.int32)], color=label)
+
+
+def iterLabelTiles(shapes, out_shape, tile_size=4096):
+    """
+    Renders shapes into a uint16 label map one tile at a time.
+
+    Shape i becomes label i+1, 0 is background. Shapes drawn later cover earlier ones.
+
+    Parameters
+    ----------
+    shapes: ShapeCoordinates or list[ shape.id, (r,g,b), list[tuple(x,y)] ]
+        Rectangles and ellipses of a ShapeCoordinates are filled natively, everything
+        else is filled as a polygon.
+    out_shape: tuple[int, int]
+        (rows, columns) of the label map.
+    tile_size: int, Default: 4096
+        Edge length of a square tile in mask pixels.
+
+    Yields
+    ------
+    tuple(y0, x0, np.ndarray)
+        top left corner of the tile in the label map and the tile itself
+    """
+    if len(shapes) > np.iinfo(np.uint16).max:
+        raise ValueError(f"{len(shapes)} shapes do not fit a uint16 label map")
+    rows, cols = out_shape
+    bins = binShapesByTile(shapes, out_shape, tile_size)
+    for y0 in range(0, rows, tile_size):
+        for x0 in range(0, cols, tile_size):
+            tile = np.zeros(
+                (min(tile_size, rows - y0), min(tile_size, cols - x0)), np.uint16
+            )
+            for i in bins.get((y0 // tile_size, x0 // tile_size), ()):
+                _fillLabel(tile, shapes, i, (x0, y0))
+            yield y0, x0, tile
+
+
+def encodeLabelRuns(tile, y0=0, x0=0):
+    """
+    Run length encodes the non background pixels of a label tile, row by row.
+
+    Returns
+    -------
+    tuple(rows, cols, lengths, labels)
+        int64 start row and column of every run in label map coordinates, its length
+        and uint16 label
+    """
+    height, width = tile.shape
+    starts = np.ones(tile.shape, bool)
+    starts[:, 1:] = tile[:, 1:] != tile[:, :-1]
+    flat = np.flatnonzero(starts)
+    # every row opens with a run, so the next start always closes the current run
+    lengths = np.diff(np.append(flat, height * width))
+    labels = tile.ravel()[flat]
+    keep = labels != 0
+    flat = flat[keep]
+    return (
+        flat // width + y0,
+        flat % width + x0,
+        lengths[keep],
+        labels[keep],
+    )
+
+
+def decodeLabelRuns(path):
+    """
+    Reads a run length encoded label map written by exportMask back into an array.
+
+    Returns
+    -------
+    np.ndarray
+        (rows, columns) uint16 label map
+    np.ndarray
+        (labels, 5) lookup table, see LABEL_LUT_HEADER
+    """
+    with np.load(path) as rle:
+        labels = np.zeros(tuple(rle["shape"]), np.uint16)
+        flat = labels.ravel()
+        starts = rle["rows"] * labels.shape[1] + rle["cols"]
+        # runs never cross rows, so they are contiguous in the flattened map
+        run_index = np.repeat(np.arange(len(starts)), rle["lengths"])
+        within = np.arange(len(run_index)) - np.repeat(
+            np.cumsum(rle["lengths"]) - rle["lengths"], rle["lengths"]
         )
-    if xy:
-        points = xy
-    return points or None
-
-
-args = sys.argv
-for args in [
-    ("_", x)
-    # image ids
-    for x in (
-        262,
-        257,
-        565,
-        566,
-        272,
-        273,
-        275,
-        277,
-        291,
-        305,
-        344,
-        341,
-        343,
-        922,
-        920,
-        921,
-        929,
-        925,
+        flat[starts[run_index] + within] = rle["labels"][run_index]
+        return labels, rle["lut"]
+
+
+def labelLookupTable(shapes):
+    """(labels, 5) int64 rows of label, shape id, r, g, b"""
+    return np.array(
+        [(i + 1, id, *rgb) for i, (id, rgb, _) in enumerate(shapes)], np.int64
+    ).reshape(-1, 5)
+
+
+@span("exportMask")
+def exportMask(
+    img,
+    downsample=10,
+    workdir=".",
+    tile_size=4096,
+    mask_format="jpeg",
+    roi_service=None,
+    shape_rows=None,
+):
+    """
+    Rasterizes an image's ROIs into a mask file using rasterizeShapesTiled.
+
+    Parameters
+    ----------
+    img: omero.gateway.ImageWrapper
+        Omero Image object from conn.getObjects().
+    downsample: int, Default: 10
+        How much smaller the mask is than the full resolution image.
+    workdir: str, Default: "."
+        Directory to write the mask to.
+    tile_size: int, Default: 4096
+        Edge length of a square tile in mask pixels.
+    mask_format: str, Default: "jpeg"
+        "jpeg" writes <name>_annot.jpeg through PIL, which needs the whole mask in memory once.
+        "npy" streams tiles into a memory mapped <name>_annot.npy, usable at full resolution.
+        "labels" streams a uint16 label map into <name>_labels.npy with the color lookup
+        table in <name>_labels_lut.csv, shape i (by id) is label i+1.
+        "rle" writes the same label map run length encoded, with its lookup table, to
+        <name>_labels_rle.npz. Read it back with decodeLabelRuns.
+    roi_service: omero.RoiService, optional
+        Unused, kept for compatibility.
+    shape_rows: list[ShapeRow], optional
+        This image's entry from a findShapesByImages call covering many images.
+
+    Returns
+    -------
+    str
+        path to the written mask
+    """
+    mask_shape = (
+        int(img.getSizeY() / downsample),
+        int(img.getSizeX() / downsample),
+        img.getSizeC(),
     )
-]:
-    # with suppress():
-    username, password = read_credentials(
-        get_parent_directory() + os.sep + "omero_user.txt"
+    # label maps draw rectangles and ellipses from their primitives
+    shapes = (
+        getShapeCoordinates(
+            img,
+            img_downsample=downsample,
+            shape_rows=shape_rows,
+            outlines=mask_format not in ("labels", "rle"),
+        )
+        or []
     )
-    img_id = args[1]
-    downsample = 10
-    workdir = "/Volumes/Siren/Prostate_data/SD_Pathomics"
-    skip_upload = False
+    name = img.getName().split(".")[0]
+
+    if mask_format == "npy":
+        path = os.path.join(workdir, name + "_annot.npy")
+        mask = np.lib.format.open_memmap(path, "w+", np.uint8, mask_shape)
+        rasterizeShapesTiled(shapes, mask, tile_size)
+        del mask
+        return path
+
+    if mask_format == "labels":
+        path = os.path.join(workdir, name + "_labels.npy")
+        labels = np.lib.format.open_memmap(path, "w+", np.uint16, mask_shape[:2])
+        for y0, x0, tile in iterLabelTiles(shapes, mask_shape[:2], tile_size):
+            labels[y0 : y0 + tile.shape[0], x0 : x0 + tile.shape[1]] = tile
+        labels.flush()
+        del labels
+        np.savetxt(
+            path[: -len(".npy")] + "_lut.csv",
+            labelLookupTable(shapes),
+            "%d",
+            ",",
+            header=LABEL_LUT_HEADER,
+            comments="",
+        )
+        return path
 
-    if len(args) > 2:
-        downsample = int(args[2])
+    if mask_format == "rle":
+        path = os.path.join(workdir, name + "_labels_rle.npz")
+        runs = [
+            encodeLabelRuns(tile, y0, x0)
+            for y0, x0, tile in iterLabelTiles(shapes, mask_shape[:2], tile_size)
+        ]
+        rows, cols, lengths, labels = (np.concatenate(part) for part in zip(*runs))
+        np.savez_compressed(
+            path,
+            shape=np.array(mask_shape[:2]),
+            rows=rows,
+            cols=cols,
+            lengths=lengths,
+            labels=labels,
+            lut=labelLookupTable(shapes),
+        )
+        return path
+
+    if mask_format != "jpeg":
+        raise ValueError(f"Unsupported mask format: {mask_format}")
+    path = os.path.join(workdir, name + "_annot.jpeg")
+    with tempfile.TemporaryFile() as buffer:
+        mask = np.memmap(buffer, np.uint8, "w+", shape=mask_shape)
+        rasterizeShapesTiled(shapes, mask, tile_size)
+        Image.fromarray(mask).save(path)
+        del mask
+    return path
 
-    if len(args) > 3:
-        workdir = str(args[3])
 
-    conn = BlitzGateway(username, password, host="lavlab.mcw.edu", secure=True)
+OMERO_HOST = "lavlab.mcw.edu"
 
-    print(conn.connect())
+_worker_conn = None
+"""long lived BlitzGateway owned by a batch worker process"""
 
+
+def connect(username, password, host=OMERO_HOST):
+    """Opens a cross-group BlitzGateway session."""
+    conn = BlitzGateway(username, password, host=host, secure=True)
+    if not conn.connect():
+        raise ConnectionError(f"Could not connect to {host} as {username}")
     conn.SERVICE_OPTS.setOmeroGroup("-1")
-    img = conn.getObject("image", img_id)
-    conn.c.sf.setSecurityContext(img.details.group)
-    rgb_mask = np.zeros(
-        (
-            int(img.getSizeY() / downsample),
-            int(img.getSizeX() / downsample),
-            img.getSizeC(),
-        ),
-        dtype=np.uint8,
+    return conn
+
+
+def _initBatchWorker(username, password, host):
+    """Pool initializer, gives each worker process its own session for the whole batch."""
+    global _worker_conn
+    with suppress():
+        _worker_conn = connect(username, password, host)
+    _worker_conn.c.enableKeepAlive(60)
+    Finalize(None, _worker_conn.close, exitpriority=10)
+
+
+def _exportMaskJob(job):
+    """
+    Exports a chunk of images' masks on the worker's session, never raises.
+
+    The chunk's shapes are fetched together with findShapesByImages.
+    """
+    img_ids, downsample, workdir, tile_size, mask_format = job
+    start = time.time()
+    try:
+        shape_rows = findShapesByImages(_worker_conn, img_ids)
+    except Exception:
+        error = traceback.format_exc()
+        return [(img_id, None, time.time() - start, error) for img_id in img_ids]
+    # the shared fetch is spread evenly over the chunk's timings
+    fetch_time = (time.time() - start) / len(img_ids)
+
+    rv = []
+    for img_id in img_ids:
+        start = time.time()
+        try:
+            img = _worker_conn.getObject("image", img_id)
+            if img is None:
+                raise LookupError(f"Image {img_id} not found")
+            _worker_conn.c.sf.setSecurityContext(img.details.group)
+            path = exportMask(
+                img,
+                downsample,
+                workdir,
+                tile_size,
+                mask_format,
+                shape_rows=shape_rows[img_id],
+            )
+            rv.append((img_id, path, fetch_time + time.time() - start, None))
+        except Exception:
+            error = traceback.format_exc()
+            rv.append((img_id, None, fetch_time + time.time() - start, error))
+    return rv
+
+
+def resolveImageIds(conn, image_ids=(), dataset_ids=(), project_ids=()):
+    """
+    Expands datasets and projects into their image ids.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway
+        Connected gateway.
+    image_ids: list[int]
+        Images to include as is.
+    dataset_ids: list[int]
+        Datasets whose images should be included.
+    project_ids: list[int]
+        Projects whose datasets' images should be included.
+
+    Returns
+    -------
+    list[int]
+        unique image ids in the order they were found
+    """
+    ids = list(image_ids)
+    datasets = list(conn.getObjects("Dataset", dataset_ids)) if dataset_ids else []
+    for project in conn.getObjects("Project", project_ids) if project_ids else []:
+        datasets.extend(project.listChildren())
+    for dataset in datasets:
+        ids.extend(img.getId() for img in dataset.listChildren())
+    return list(dict.fromkeys(ids))
+
+
+def exportMasks(
+    image_ids,
+    username,
+    password,
+    downsample=10,
+    workdir=".",
+    tile_size=4096,
+    mask_format="jpeg",
+    workers=4,
+    chunk_size=25,
+    host=OMERO_HOST,
+):
+    """
+    Exports masks for many images over a pool of worker processes.
+
+    Each worker keeps one session for the whole batch. A failed image is reported and
+    skipped, it does not stop the batch.
+
+    Parameters
+    ----------
+    image_ids: list[int]
+        Images to export.
+    username: str
+        OMERO username.
+    password: str
+        OMERO password.
+    downsample, workdir, tile_size, mask_format:
+        Passed through to exportMask.
+    workers: int, Default: 4
+        Number of worker processes.
+    chunk_size: int, Default: 25
+        Images handed to a worker at once, their shapes are fetched in one go.
+    host: str, Default: OMERO_HOST
+        OMERO server.
+
+    Returns
+    -------
+    list[tuple(img_id, path, seconds, error)]
+        one entry per image in completion order, error is a traceback string or None
+    """
+    image_ids = list(image_ids)
+    # keep every worker busy when there are only a few images
+    chunk_size = max(min(chunk_size, -(-len(image_ids) // workers)), 1)
+    jobs = [
+        (image_ids[i : i + chunk_size], downsample, workdir, tile_size, mask_format)
+        for i in range(0, len(image_ids), chunk_size)
+    ]
+    results = []
+    # spawn, Ice does not support fork without exec
+    with get_context("spawn").Pool(
+        min(workers, len(jobs)) or 1,
+        initializer=_initBatchWorker,
+        initargs=(username, password, host),
+    ) as pool:
+        for chunk in pool.imap_unordered(_exportMaskJob, jobs):
+            for result in chunk:
+                img_id, path, seconds, error = result
+                if error is None:
+                    print(f"image {img_id} took: {seconds:.1f}s -> {path}")
+                else:
+                    print(f"image {img_id} FAILED after {seconds:.1f}s\n{error}")
+                results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Exports OMERO ROIs as mask images")
+    parser.add_argument("image_ids", nargs="*", type=int, help="image ids to export")
+    parser.add_argument(
+        "--dataset", nargs="+", type=int, default=[], help="dataset ids"
+    )
+    parser.add_argument(
+        "--project", nargs="+", type=int, default=[], help="project ids"
+    )
+    parser.add_argument("-d", "--downsample", type=int, default=10)
+    parser.add_argument(
+        "-w", "--workdir", default="/Volumes/Siren/Prostate_data/SD_Pathomics"
+    )
+    parser.add_argument("-j", "--workers", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=25)
+    parser.add_argument("--tile-size", type=int, default=4096)
+    parser.add_argument(
+        "--format", choices=("jpeg", "npy", "labels", "rle"), default="jpeg"
+    )
+    parser.add_argument(
+        "--credentials", default=get_parent_directory() + os.sep + "omero_user.txt"
+    )
+    parser.add_argument(
+        "--metrics-jsonl", help="append stage timings of every worker to this file"
+    )
+    parser.add_argument(
+        "--metrics-prom", help="write a Prometheus textfile of the metrics when done"
+    )
+    args = parser.parse_args()
+    # workers inherit this, so it has to happen before the pool starts. the textfile
+    # needs the workers' spans, which only reach this process through a file
+    configure(args.metrics_jsonl, verbose=False, collect=bool(args.metrics_prom))
+
+    username, password = read_credentials(args.credentials)
+    with suppress():
+        conn = connect(username, password)
+    try:
+        image_ids = resolveImageIds(conn, args.image_ids, args.dataset, args.project)
+    finally:
+        conn.close()
+    if not image_ids:
+        parser.error("no images to export")
+
+    begin = time.time()
+    results = exportMasks(
+        image_ids,
+        username,
+        password,
+        args.downsample,
+        args.workdir,
+        args.tile_size,
+        args.format,
+        args.workers,
+        args.chunk_size,
+    )
+    failed = [img_id for img_id, _, _, error in results if error is not None]
+    print(
+        f"exported {len(results) - len(failed)}/{len(results)} images in {time.time() - begin:.1f}s"
     )
-    rgb_mask[:] = 255
-    for id, rgb, xy in getShapesAsPoints(img, img_downsample=downsample):
-        yx = np.array(xy, np.int32)  # Ensure the points are of integer type
-        yx = yx.reshape((-1, 1, 2))  # Reshape to (-1, 1, 2)
-        cv2.fillPoly(rgb_mask, [yx], color=rgb)
-
-    mask = Image.fromarray(rgb_mask)
-    path = os.path.join(workdir, img.getName().split(".")[0] + "_annot.jpeg")
-    mask.save(path)
-    conn.close()
+    if args.metrics_prom:
+        writePrometheus(args.metrics_prom)
+    if failed:
+        print(f"failed images: {' '.join(map(str, failed))}")
+        sys.exit(1)
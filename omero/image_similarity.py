@@ -0,0 +1,180 @@
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from scipy import fft
+
+DIHEDRAL = tuple((k, flip) for flip in (False, True) for k in range(4))
+"""(quarter turns, horizontal flip) of every rotation and mirror of a square"""
+
+Similarity = namedtuple("Similarity", ["index", "score", "transform"])
+"""candidate index, normalized cross correlation and the DIHEDRAL entry it matched at"""
+
+
+def toGray(img):
+    """float32 grayscale of an RGB(A) or grayscale image or array"""
+    img = np.asarray(img)
+    if img.ndim == 3:
+        img = cv2.cvtColor(
+            np.ascontiguousarray(img[..., :3], np.uint8), cv2.COLOR_RGB2GRAY
+        )
+    return img.astype(np.float32)
+
+
+def normalize(gray, size):
+    """resizes to size x size, zero mean and unit norm so dot products are correlations"""
+    img = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA)
+    img -= img.mean()
+    norm = np.linalg.norm(img)
+    return img / norm if norm > 0 else img
+
+
+def candidateSpectra(candidates, size):
+    """
+    Fourier transforms of candidates as SimilarityMatcher compares them, pass these
+    instead of the images to score the same candidates against many queries
+    """
+    grays = np.stack([normalize(toGray(img), size) for img in candidates])
+    return fft.rfft2(grays).conj()
+
+
+def orient(img, transform):
+    """applies a DIHEDRAL entry"""
+    quarter_turns, flip = transform
+    img = np.rot90(img, quarter_turns)
+    return img[:, ::-1] if flip else img
+
+
+class SimilarityMatcher:
+    """
+    Finds which candidate images show the same slide as a query.
+
+    The query is resized, normalized and Fourier transformed once per resolution and
+    orientation. Candidates are scored in batches at coarse_size, where the normalized
+    cross correlation over every allowed shift and every orientation is one FFT product.
+    Only the best few are scored again at fine_size, in the orientation they matched.
+
+    Parameters
+    ----------
+    query: PIL.Image.Image or np.ndarray
+        Image to look for, ex: a large recon.
+    coarse_size: int, Default: 64
+        Edge length candidates are first compared at.
+    fine_size: int, Default: 256
+        Edge length the best coarse candidates are confirmed at.
+    max_shift: float, Default: 0.1
+        Largest translation tolerated, as a fraction of the image edge.
+    transforms: tuple, Default: DIHEDRAL
+        Orientations of the query tried, pass ((0, False),) to only match it as is.
+    """
+
+    def __init__(
+        self,
+        query,
+        coarse_size=64,
+        fine_size=256,
+        max_shift=0.1,
+        transforms=DIHEDRAL,
+    ):
+        self.coarse_size = coarse_size
+        self.fine_size = fine_size
+        self.max_shift = max_shift
+        self.transforms = tuple(transforms)
+        gray = toGray(query)
+        self.levels = {
+            size: self._prepare(gray, size) for size in (coarse_size, fine_size)
+        }
+
+    def _prepare(self, gray, size):
+        base = normalize(gray, size)
+        oriented = np.stack([orient(base, transform) for transform in self.transforms])
+        # circular shift k is really a shift of k or k - size
+        shifts = np.minimum(np.arange(size), size - np.arange(size))
+        allowed = shifts <= int(self.max_shift * size)
+        return fft.rfft2(oriented), allowed[:, None] & allowed[None, :]
+
+    def _scores(self, candidates, size, transforms=None, conj=None):
+        """
+        (n, orientations) best correlations, or (n,) with one transform index per candidate
+        """
+        spectra, allowed = self.levels[size]
+        if conj is None:
+            conj = candidateSpectra(candidates, size)
+        if transforms is None:
+            products = spectra[None] * conj[:, None]
+        else:
+            products = spectra[transforms] * conj
+        corr = fft.irfft2(products, s=(size, size), workers=-1)
+        return corr[..., allowed].max(-1)
+
+    def coarseScores(self, candidates, spectra=None):
+        """
+        Scores candidates at coarse_size.
+
+        Parameters
+        ----------
+        candidates: list[PIL.Image.Image or np.ndarray]
+            Images to score, ignored when spectra is given.
+        spectra: np.ndarray, optional
+            candidateSpectra(candidates, coarse_size).
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            best correlation and index into transforms of each candidate
+        """
+        scores = self._scores(candidates, self.coarse_size, conj=spectra)
+        best = scores.argmax(1)
+        return scores[np.arange(len(scores)), best], best
+
+    def fineScores(self, candidates, transforms, spectra=None):
+        """
+        Scores candidates at fine_size, each in one orientation.
+
+        Parameters
+        ----------
+        candidates: list[PIL.Image.Image or np.ndarray]
+            Images to score, ignored when spectra is given.
+        transforms: list[int]
+            Index into transforms per candidate, ex: from coarseScores.
+        spectra: np.ndarray, optional
+            candidateSpectra(candidates, fine_size).
+
+        Returns
+        -------
+        np.ndarray
+        """
+        return self._scores(candidates, self.fine_size, list(transforms), spectra)
+
+    def score(self, img):
+        """returns the Similarity of a single image at fine_size, over all orientations"""
+        scores = self._scores([img], self.fine_size)[0]
+        best = int(scores.argmax())
+        return Similarity(0, float(scores[best]), self.transforms[best])
+
+    def match(self, candidates, threshold=0.7, refine=3):
+        """
+        Finds the first candidate showing the query.
+
+        Parameters
+        ----------
+        candidates: list[PIL.Image.Image or np.ndarray]
+            Images to search, any sizes.
+        threshold: float, Default: 0.7
+            Fine correlation a candidate must exceed.
+        refine: int, Default: 3
+            How many of the best coarse candidates are confirmed at fine_size, in order,
+            stopping at the first that passes.
+
+        Returns
+        -------
+        Similarity or None
+        """
+        if not len(candidates):
+            return None
+        coarse, transforms = self.coarseScores(candidates)
+        for i in np.argsort(-coarse)[:refine]:
+            score = self.fineScores([candidates[i]], [transforms[i]])[0]
+            if score > threshold:
+                return Similarity(int(i), float(score), self.transforms[transforms[i]])
+        return None
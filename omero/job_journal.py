@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+DEFAULT_JOURNAL_PATH = "roi_cloudifier_journal.jsonl"
+
+STAGES = ("matched", "registered", "reviewed", "uploading", "uploaded", "failed")
+"""stages a slide goes through, failed can follow any of them"""
+
+
+def fileFingerprint(*paths):
+    """sha1 of the paths' names, sizes and mtimes, missing files count as empty"""
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        except (FileNotFoundError, TypeError):
+            digest.update(f"{path}:missing;".encode())
+    return digest.hexdigest()
+
+
+class JobJournal:
+    """
+    Append-only JSON lines record of every slide's progress through a run.
+
+    Each line holds a slide path, a stage from STAGES, the fingerprint of the slide's
+    inputs at the time and whatever the stage needs to resume, ex: the matched remote
+    image id or the roi chunks an interrupted upload saved. Replaying the file gives the
+    last state of every slide, and entries whose fingerprint no longer matches the
+    inputs are ignored so changed slides start over. forget() voids stages that no
+    longer hold, ex: a matched image that was deleted since.
+    A line cut short by a crash is skipped.
+
+    Parameters
+    ----------
+    path: str, Default: roi_cloudifier_journal.jsonl
+        Journal file, created if missing.
+    """
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self.slides = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        continue
+        self.file = open(path, "a")
+
+    def _apply(self, entry):
+        state = self.slides.get(entry["path"])
+        if state is None or state["fingerprint"] != entry["fingerprint"]:
+            state = self.slides[entry["path"]] = {
+                "fingerprint": entry["fingerprint"],
+                "stages": {},
+            }
+        if entry["stage"] == "forget":
+            for stage in entry["data"]["stages"]:
+                state["stages"].pop(stage, None)
+            return
+        if entry["stage"] != "failed":
+            # a success after a failure means the failure was retried
+            state["stages"].pop("failed", None)
+        state["stages"][entry["stage"]] = entry.get("data", {})
+
+    def record(self, path, stage, fingerprint, **data):
+        """appends a stage of a slide, data must be json serializable"""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage}, expected one of {STAGES}")
+        self._append(path, stage, fingerprint, data)
+
+    def forget(self, path, fingerprint, *stages):
+        """appends that finished stages of a slide are void, resuming redoes them"""
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages {unknown}, expected some of {STAGES}")
+        self._append(path, "forget", fingerprint, {"stages": list(stages)})
+
+    def _append(self, path, stage, fingerprint, data):
+        entry = {
+            "path": path,
+            "stage": stage,
+            "fingerprint": fingerprint,
+            "time": time.time(),
+            "data": data,
+        }
+        with self.lock:
+            self._apply(entry)
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def resume(self, path, fingerprint):
+        """returns {stage: data} finished for path with these inputs, empty if none"""
+        with self.lock:
+            state = self.slides.get(path)
+            if state is None or state["fingerprint"] != fingerprint:
+                return {}
+            return dict(state["stages"])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,144 @@
+import os
+import fcntl
+import hashlib
+import tempfile
+import zipfile
+from contextlib import contextmanager
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "LARGE_RECON_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "large_recons")
+)
+DEFAULT_MAX_BYTES = int(float(os.environ.get("LARGE_RECON_CACHE_GB", 20)) * 2**30)
+
+
+def pixelDataVersion(img):
+    """
+    Gets a value that changes whenever an image's pixel data is replaced.
+
+    Parameters
+    ----------
+    img: omero.gateway.ImageWrapper
+        Omero Image object from conn.getObjects().
+
+    Returns
+    -------
+    int
+        id of the primary pixels' last update event
+    """
+    pixels = img.getPrimaryPixels()
+    event = pixels.getDetails().getUpdateEvent()
+    return event.getId() if event is not None else pixels.getId()
+
+
+class LargeReconCache:
+    """
+    Content addressed on-disk cache of large recon arrays.
+
+    Entries are keyed by (image id, pixel data version, downsample factor) and stored as
+    compressed .npz files. Reading an entry marks it as recently used, and once the
+    directory grows past max_bytes the least recently used entries are evicted. Writes
+    are atomic renames and creation/eviction hold file locks, so several processes can
+    share one directory.
+
+    Parameters
+    ----------
+    directory: str, Default: $LARGE_RECON_CACHE or ~/.cache/large_recons
+        Where entries are stored.
+    max_bytes: int, Default: $LARGE_RECON_CACHE_GB (20) GiB
+        Size cap for all entries together.
+    """
+
+    SUFFIX = ".npz"
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, img, downsample_factor):
+        """sha1 of (image id, pixel data version, downsample factor)"""
+        raw = f"{img.getId()}:{pixelDataVersion(img)}:{int(downsample_factor)}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    @contextmanager
+    def _lock(self, name):
+        with open(os.path.join(self.directory, name + ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, img, downsample_factor):
+        """returns the cached array or None"""
+        return self._read(self.key(img, downsample_factor))
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                array = entry["recon"]
+            os.utime(path)  # mark as recently used
+            return array
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # missing, evicted by another process or unreadable
+            return None
+
+    def put(self, img, downsample_factor, array):
+        """stores array, then evicts down to max_bytes"""
+        self._write(self.key(img, downsample_factor), array)
+        self.evict()
+
+    def _write(self, key, array):
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez_compressed(file, recon=array)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def getOrCreate(self, img, downsample_factor, create):
+        """
+        Returns the cached array, calling create() and storing its result on a miss.
+
+        Only one process creates a given entry, the rest wait for it and read it back.
+        """
+        key = self.key(img, downsample_factor)
+        array = self._read(key)
+        if array is not None:
+            return array
+        with self._lock(key):
+            array = self._read(key)
+            if array is None:
+                array = np.asarray(create())
+                self._write(key, array)
+        self.evict()
+        return array
+
+    def evict(self):
+        """removes least recently used entries until the cache fits in max_bytes"""
+        with self._lock("evict"):
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.SUFFIX):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # the entry's creation lock goes too, at worst a racing process
+                # creates the entry twice, the atomic rename keeps that safe
+                for stale in (path, path[: -len(self.SUFFIX)] + ".lock"):
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+                total -= size
@@ -0,0 +1,329 @@
+import io
+import os
+import json
+import fnmatch
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+DEFAULT_INDEX_PATH = os.environ.get(
+    "SIREN_INDEX", os.path.join(os.path.expanduser("~"), ".cache", "siren_index.sqlite")
+)
+
+IndexedRecon = namedtuple(
+    "IndexedRecon", ["path", "registration_path", "details", "mtime_ns"]
+)
+"""an annotated recon, details is None when the path does not fit the capture groups"""
+
+
+def _tiffThumbnail(path, size):
+    """
+    TIFF thumbnail from the smallest pyramid level still covering size, read one strip
+    or tile at a time keeping every factor-th pixel, so the full resolution image is
+    never held in memory. Returns None for layouts this does not handle.
+    """
+    try:
+        tif = tifffile.TiffFile(path)
+    except tifffile.TiffFileError:
+        return None
+    with tif:
+        levels = tif.series[0].levels
+        page = levels[0].keyframe
+        for level in levels[1:]:
+            if (
+                level.keyframe.imagewidth >= size[0]
+                and level.keyframe.imagelength >= size[1]
+            ):
+                page = level.keyframe
+        samples = page.samplesperpixel
+        if page.imagedepth > 1 or (
+            samples > 1 and page.planarconfig != tifffile.PLANARCONFIG.CONTIG
+        ):
+            return None
+        height, width = page.imagelength, page.imagewidth
+        factor = max(min(width // size[0], height // size[1]), 1)
+        out = np.zeros((-(-height // factor), -(-width // factor), samples), page.dtype)
+        for segment, (_, _, y, x, _), _ in page.segments():
+            if segment is None:
+                continue
+            segment = segment[0]  # (length, width, samples)
+            # first rows and columns of the segment on the factor grid
+            y0, x0 = -y % factor, -x % factor
+            kept = segment[y0::factor, x0::factor]
+            rows = min(kept.shape[0], out.shape[0] - (y + y0) // factor)
+            cols = min(kept.shape[1], out.shape[1] - (x + x0) // factor)
+            if rows > 0 and cols > 0:
+                out[
+                    (y + y0) // factor : (y + y0) // factor + rows,
+                    (x + x0) // factor : (x + x0) // factor + cols,
+                ] = kept[:rows, :cols]
+    return Image.fromarray(out[..., 0] if samples == 1 else out).resize(size)
+
+
+def loadThumbnail(path, size):
+    """
+    Decodes a thumbnail without resampling the full resolution image.
+
+    TIFFs are read from their smallest fitting pyramid level, one strip or tile at a
+    time. JPEGs are decoded at reduced scale with draft, other formats are box reduced by
+    the largest integer factor that still covers size before the final resize.
+
+    Parameters
+    ----------
+    path: str
+        Image file.
+    size: tuple(int, int)
+        Thumbnail width and height, aspect ratio is not kept.
+
+    Returns
+    -------
+    PIL.Image.Image
+    """
+    thumbnail = _tiffThumbnail(path, size)
+    if thumbnail is not None:
+        return thumbnail
+    with Image.open(path) as img:
+        img.draft(None, size)
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor > 1:
+            try:
+                reduced = img.reduce(factor)
+            except ValueError:  # modes reduce does not support, ex: palette
+                reduced = img
+            return reduced.resize(size)
+        return img.resize(size)
+
+
+class SirenIndex:
+    """
+    On-disk index of annotated large recons, their registration images and thumbnails.
+
+    Directories are walked in parallel, one tree level at a time. A directory whose mtime
+    is unchanged reuses its stored listing instead of being listed again, and annotated
+    files are only re-read when their mtime or size changed, so repeated runs over the
+    network volume mostly cost one stat per directory and per annotated file.
+
+    Parameters
+    ----------
+    reader: SirenFileReader
+        Supplies FN_GLOB, THUMBNAIL_SIZE, parse() and registrationPattern().
+    path: str, Default: $SIREN_INDEX or ~/.cache/siren_index.sqlite
+        sqlite file of the index.
+    workers: int, Default: 16
+        Threads used to stat, list and thumbnail files.
+    """
+
+    def __init__(self, reader, path=DEFAULT_INDEX_PATH, workers=16):
+        self.reader = reader
+        self.workers = workers
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            pragma journal_mode=wal;
+            create table if not exists dirs (
+                path text primary key, mtime_ns integer, subdirs text, files text
+            );
+            create table if not exists recons (
+                path text primary key, dir text, mtime_ns integer, size integer,
+                registration_path text, project text, patient text, slide text,
+                downsample text, thumbnail blob
+            );
+            create index if not exists recons_dir on recons (dir);
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _subtree(root):
+        """
+        (lower, upper) bounds of the paths under root, compared as strings since LIKE
+        would treat the _ of Siren paths as a wildcard and match sibling trees
+        """
+        prefix = os.path.join(os.path.normpath(root), "")
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    def _under(self, table, root):
+        return self.db.execute(
+            f"select * from {table} where path = ? or (path >= ? and path < ?)",
+            (os.path.normpath(root), *self._subtree(root)),
+        )
+
+    @staticmethod
+    def _scanDir(path, known):
+        """returns (path, mtime_ns, listing), listing is None when known is still valid"""
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if known is not None and known[0] == mtime_ns:
+                return path, mtime_ns, None
+            subdirs, files = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+            return path, mtime_ns, (sorted(subdirs), sorted(files))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return path, None, ([], [])
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _registrationPath(self, path, files):
+        """first file of the same directory matching the registration pattern"""
+        pattern = os.path.basename(self.reader.registrationPattern(path))
+        for name in fnmatch.filter(files, pattern):
+            return os.path.join(os.path.dirname(path), name)
+        return None
+
+    def _thumbnail(self, path):
+        buf = io.BytesIO()
+        loadThumbnail(path, self.reader.THUMBNAIL_SIZE).save(buf, "PNG")
+        return buf.getvalue()
+
+    def update(self, root):
+        """
+        Brings the index of root up to date.
+
+        Returns
+        -------
+        int
+            number of annotated recons added or re-read
+        """
+        root = os.path.normpath(root)
+        known = {
+            path: (mtime_ns, json.loads(subdirs), json.loads(files))
+            for path, mtime_ns, subdirs, files in self._under("dirs", root)
+        }
+        stored = {row[0]: row[2:4] for row in self._under("recons", root)}
+        annot_pattern = os.path.basename(self.reader.FN_GLOB)
+
+        listings = {}
+        changed_dirs = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            frontier = [root]
+            while frontier:
+                scanned = executor.map(
+                    lambda path: self._scanDir(path, known.get(path)), frontier
+                )
+                frontier = []
+                for path, mtime_ns, listing in scanned:
+                    if mtime_ns is None:  # vanished or unreadable
+                        continue
+                    if listing is None:
+                        listing = known[path][1:]
+                    else:
+                        changed_dirs.append((path, mtime_ns, *listing))
+                    listings[path] = listing
+                    frontier.extend(os.path.join(path, d) for d in listing[0])
+
+            annotated = [
+                (os.path.join(path, name), path)
+                for path, (_, files) in listings.items()
+                for name in fnmatch.filter(files, annot_pattern)
+            ]
+            stats = executor.map(self._stat, [path for path, _ in annotated])
+            changed = [
+                (path, directory, stat)
+                for (path, directory), stat in zip(annotated, stats)
+                if stat is not None and stored.get(path) != stat
+            ]
+            thumbnails = executor.map(self._thumbnail, [path for path, _, _ in changed])
+
+            rows = []
+            for (path, directory, (mtime_ns, size)), thumbnail in zip(
+                changed, thumbnails
+            ):
+                try:
+                    project, patient, (slide, downsample) = self.reader.parse(path)
+                except AttributeError:
+                    project = patient = slide = downsample = None
+                registration_path = self._registrationPath(path, listings[directory][1])
+                rows.append(
+                    (
+                        path,
+                        directory,
+                        mtime_ns,
+                        size,
+                        registration_path,
+                        project,
+                        patient,
+                        slide,
+                        downsample,
+                        thumbnail,
+                    )
+                )
+
+        with self.db:
+            # registration partners can appear without the annotated file changing
+            changed_paths = {row[0] for row in rows}
+            for path, _, _, files in changed_dirs:
+                for name in fnmatch.filter(files, annot_pattern):
+                    recon = os.path.join(path, name)
+                    if recon not in changed_paths:
+                        self.db.execute(
+                            "update recons set registration_path = ? where path = ?",
+                            (self._registrationPath(recon, files), recon),
+                        )
+            self.db.executemany(
+                "insert or replace into recons values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.db.executemany(
+                "insert or replace into dirs values (?, ?, ?, ?)",
+                [
+                    (path, mtime_ns, json.dumps(subdirs), json.dumps(files))
+                    for path, mtime_ns, subdirs, files in changed_dirs
+                ],
+            )
+            present = {path for path, _ in annotated}
+            self.db.executemany(
+                "delete from recons where path = ?",
+                [(path,) for path in stored if path not in present],
+            )
+            self.db.executemany(
+                "delete from dirs where path = ?",
+                [(path,) for path in known if path not in listings],
+            )
+        return len(rows)
+
+    def thumbnails(self, root):
+        """yields (thumbnail, path) of every indexed annotated recon under root"""
+        rows = self.db.execute(
+            "select path, thumbnail from recons where path >= ? and path < ? "
+            "order by path",
+            self._subtree(root),
+        ).fetchall()
+        for path, thumbnail in rows:
+            yield Image.open(io.BytesIO(thumbnail)), path
+
+    def lookup(self, path):
+        """returns the IndexedRecon of path or None when it is not indexed"""
+        row = self.db.execute(
+            "select path, registration_path, project, patient, slide, downsample, "
+            "mtime_ns from recons where path = ?",
+            (path,),
+        ).fetchone()
+        if row is None:
+            return None
+        path, registration_path, project, patient, slide, downsample, mtime_ns = row
+        details = None
+        if project is not None:
+            details = (project, patient, (slide, downsample))
+        return IndexedRecon(path, registration_path, details, mtime_ns)
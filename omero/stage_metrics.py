@@ -0,0 +1,254 @@
+import os
+import re
+import json
+import time
+import uuid
+import atexit
+import bisect
+import tempfile
+import threading
+from contextlib import contextmanager
+
+JSONL_ENV = "STAGE_METRICS_JSONL"
+"""JSON lines file every process appends its events to, inherited by worker processes"""
+
+RUN_ENV = "STAGE_METRICS_RUN"
+"""id of the current run, tags its events since runs append to the same file"""
+
+VERBOSE_ENV = "STAGE_METRICS_VERBOSE"
+"""set to 0 to stop spans printing "<stage> took: <seconds>" """
+
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+"""histogram upper bounds in seconds"""
+
+
+def _labelKey(labels):
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def _metricName(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _formatLabels(pairs):
+    if not pairs:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metrics:
+    """
+    Per stage duration histograms and gauges of one process.
+
+    Parameters
+    ----------
+    buckets: tuple[float], Default: BUCKETS
+        Histogram upper bounds in seconds, an infinite bucket is always added.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, labels=None):
+        key = (name, _labelKey(labels or {}))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # counts per bucket (+inf last), sum, count
+                histogram = self.histograms[key] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                    0,
+                ]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def setGauge(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[(name, _labelKey(labels or {}))] = value
+
+    def summary(self):
+        """{stage: (count, total seconds, mean seconds)} summed over labels"""
+        counts, totals = {}, {}
+        with self.lock:
+            for (name, _), (_, total, count) in self.histograms.items():
+                counts[name] = counts.get(name, 0) + count
+                totals[name] = totals.get(name, 0.0) + total
+        return {
+            name: (counts[name], totals[name], totals[name] / counts[name])
+            for name in counts
+        }
+
+    def prometheus(self, prefix="stage"):
+        """renders the Prometheus text exposition format"""
+        lines = [
+            f"# HELP {prefix}_duration_seconds Time spent per pipeline stage.",
+            f"# TYPE {prefix}_duration_seconds histogram",
+        ]
+        with self.lock:
+            for (name, labels), (counts, total, count) in sorted(
+                self.histograms.items()
+            ):
+                pairs = (("stage", name),) + labels
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(
+                        f"{prefix}_duration_seconds_bucket"
+                        f"{_formatLabels(pairs + (('le', le),))} {cumulative}"
+                    )
+                lines.append(
+                    f"{prefix}_duration_seconds_sum{_formatLabels(pairs)} {total}"
+                )
+                lines.append(
+                    f"{prefix}_duration_seconds_count{_formatLabels(pairs)} {count}"
+                )
+            typed = set()
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = f"{prefix}_{_metricName(name)}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} gauge")
+                    typed.add(metric)
+                lines.append(f"{metric}{_formatLabels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+"""metrics of this process"""
+
+_emit_lock = threading.Lock()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def configure(jsonl_path=None, verbose=None, collect=False):
+    """
+    Sets where events are written and whether spans print.
+
+    Settings go through environment variables so worker processes started afterwards
+    write to the same file. Every configured file starts a new run id, writePrometheus
+    only reads the events of the current run.
+
+    Parameters
+    ----------
+    jsonl_path: str, optional
+        JSON lines file events are appended to.
+    verbose: bool, optional
+        Whether spans print their duration.
+    collect: bool, Default: False
+        Without jsonl_path, write events to a temporary file removed at exit anyway,
+        otherwise writePrometheus misses everything worker processes recorded.
+    """
+    if jsonl_path is None and collect and not os.environ.get(JSONL_ENV):
+        fd, jsonl_path = tempfile.mkstemp(prefix="stage_metrics_", suffix=".jsonl")
+        os.close(fd)
+        atexit.register(_remove, jsonl_path)
+    if jsonl_path is not None:
+        os.environ[JSONL_ENV] = os.path.abspath(jsonl_path)
+        os.environ[RUN_ENV] = uuid.uuid4().hex
+    if verbose is not None:
+        os.environ[VERBOSE_ENV] = "1" if verbose else "0"
+
+
+def _emit(event):
+    path = os.environ.get(JSONL_ENV)
+    if not path:
+        return
+    event.update(
+        time=time.time(),
+        run=os.environ.get(RUN_ENV),
+        pid=os.getpid(),
+        thread=threading.current_thread().name,
+    )
+    line = json.dumps(event) + "\n"
+    # one append per line keeps lines whole when processes share the file
+    with _emit_lock, open(path, "a") as file:
+        file.write(line)
+
+
+def observe(name, seconds, **labels):
+    """records a stage duration"""
+    METRICS.observe(name, seconds, labels)
+    _emit({"type": "span", "name": name, "seconds": seconds, "labels": labels})
+    if os.environ.get(VERBOSE_ENV, "1") != "0":
+        print(f"{name} took: {seconds}")
+
+
+def gauge(name, value, **labels):
+    """records the current value of something, ex: a queue depth"""
+    METRICS.setGauge(name, value, labels)
+    _emit({"type": "gauge", "name": name, "value": value, "labels": labels})
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Times a stage, usable as a context manager or a decorator.
+
+    Spans that raise are recorded with status="error".
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        observe(name, time.perf_counter() - start, status="error", **labels)
+        raise
+    observe(name, time.perf_counter() - start, **labels)
+
+
+def loadJsonl(path, buckets=BUCKETS, run=None):
+    """
+    rebuilds Metrics from a JSON lines file, ex: to combine worker processes.
+    only events of run are read when given, ex: os.environ[RUN_ENV]
+    """
+    metrics = Metrics(buckets)
+    with open(path) as file:
+        for line in file:
+            try:
+                event = json.loads(line)
+            except ValueError:  # cut short by a crash
+                continue
+            if run is not None and event.get("run") != run:
+                continue
+            if event["type"] == "span":
+                metrics.observe(event["name"], event["seconds"], event["labels"])
+            elif event["type"] == "gauge":
+                metrics.setGauge(event["name"], event["value"], event["labels"])
+    return metrics
+
+
+def writePrometheus(path, metrics=None, prefix="stage"):
+    """
+    Writes metrics (default: the current run of the JSON lines file if configured, else
+    this process) as a Prometheus textfile, atomically so a collector never reads half
+    a file.
+    """
+    if metrics is None:
+        jsonl_path = os.environ.get(JSONL_ENV)
+        if jsonl_path:
+            metrics = loadJsonl(jsonl_path, run=os.environ.get(RUN_ENV))
+        else:
+            metrics = METRICS
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(metrics.prometheus(prefix))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [
+    os.path.dirname(HERE),
+    os.path.join(os.path.dirname(HERE), "benchmarks"),
+]
+
+from cohort_matching import assign, similarityMatrix
+from image_similarity import SimilarityMatcher
+from synthetic import tissueImage
+
+SIZE = 256
+
+
+def texture(seed, amp):
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(0, 1, (SIZE, SIZE)).astype(np.float32)
+    return cv2.GaussianBlur(noise, (0, 0), 1)[..., None] * amp
+
+
+def toImage(arr):
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+
+
+def slide(seed):
+    return tissueImage((SIZE, SIZE), seed).astype(np.float32) + texture(seed, 250)
+
+
+def test_near_duplicate_does_not_win_on_coarse_score():
+    a, b = slide(1), slide(2)
+    # the same tissue rescanned, shifted and noisier, scores lower at the coarse size
+    # than a blurred copy of the local slide does, but higher at the fine size
+    fake = cv2.GaussianBlur(a, (0, 0), 4) + texture(3, 250)
+    true_a = np.roll(a, (4, -3), (0, 1)) + texture(7, 350)
+    true_b = np.roll(b, (-2, 5), (0, 1)) + texture(8, 350)
+    local = [toImage(a), toImage(b)]
+    remote = [toImage(fake), toImage(true_a), toImage(true_b)]
+
+    matcher = SimilarityMatcher(local[0])
+    coarse, _ = matcher.coarseScores(remote[:2])
+    assert coarse[0] > matcher.score(remote[1]).score
+
+    scores, _ = similarityMatrix(local, remote, refine=1)
+    for i, j in zip(*np.nonzero(np.isfinite(scores))):
+        fine = SimilarityMatcher(local[i]).score(remote[j]).score
+        assert abs(scores[i, j] - fine) < 1e-4
+    assert not np.isfinite(scores[1, 0])
+
+    pairs = assign(scores, min_score=0.5)
+    assert [(row, col) for row, col, _, _ in pairs] == [(0, 1), (1, 2)]
+    for row, col, score, margin in pairs:
+        competing = [s for s in scores[row] if np.isfinite(s) and s != score]
+        competing += [s for s in scores[:, col] if np.isfinite(s) and s != score]
+        assert np.isclose(margin, score - max(competing) if competing else score)
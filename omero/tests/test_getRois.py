@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [
+    os.path.dirname(HERE),
+    os.path.join(os.path.dirname(HERE), "benchmarks"),
+]
+os.environ.setdefault("STAGE_METRICS_VERBOSE", "0")
+
+pytest.importorskip("omero.gateway")
+
+from getRois import ShapeRow, exportMask, decodeLabelRuns, getShapeCoordinates
+from synthetic import rgbaToInt
+from fake_gateway import FakeGateway
+
+# full resolution geometry, the mask is downsampled 10 times
+RECTANGLE = (100.0, 200.0, 300.0, 400.0)
+ELLIPSE = (1000.0, 1000.0, 200.0, 100.0)
+
+
+@pytest.fixture
+def image():
+    gateway = FakeGateway()
+    rows = [
+        ShapeRow(1, 0, "Rectangle", rgbaToInt(255, 0, 0), list(RECTANGLE)),
+        ShapeRow(2, 0, "Ellipse", rgbaToInt(0, 255, 0), list(ELLIPSE)),
+    ]
+    return gateway.addImage((2000, 1500), rows)
+
+
+def test_shape_coordinates_with_ellipse(image):
+    shapes = getShapeCoordinates(image, img_downsample=10)
+    assert list(shapes.kinds) == ["Rectangle", "Ellipse"]
+    _, _, ellipse_xy = shapes[1]
+    radii = (ellipse_xy - (100, 100)) / (20, 10)
+    np.testing.assert_allclose(np.hypot(*radii.T), 1)
+
+
+@pytest.mark.parametrize("mask_format", ["labels", "rle"])
+def test_label_map_with_rectangle_and_ellipse(image, tmp_path, mask_format):
+    # tiles smaller than the shapes, so both are drawn across tile borders
+    path = exportMask(image, 10, str(tmp_path), tile_size=16, mask_format=mask_format)
+    if mask_format == "rle":
+        labels, lut = decodeLabelRuns(path)
+    else:
+        labels = np.load(path)
+        lut = np.loadtxt(
+            path[: -len(".npy")] + "_lut.csv", np.int64, delimiter=",", skiprows=1
+        )
+
+    assert labels.shape == (150, 200)
+    np.testing.assert_array_equal(lut, [[1, 1, 255, 0, 0], [2, 2, 0, 255, 0]])
+    # the rectangle spans x 10..40 and y 20..60, corners included
+    assert (labels[20:61, 10:41] == 1).all()
+    assert (labels == 1).sum() == 31 * 41
+    # the ellipse is centered on (100, 100) with radii 20 and 10
+    assert labels[100, 100] == 2 and labels[100, 81] == 2 and labels[91, 100] == 2
+    # boundary pixels are filled, so the area is about that of radii 20.5 and 10.5
+    area = np.pi * 20.5 * 10.5
+    assert abs((labels == 2).sum() - area) < 0.05 * area
+    assert labels[0, 0] == 0 and labels[100, 130] == 0
@@ -0,0 +1,271 @@
+import io
+import os
+import sqlite3
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from omero.rtypes import rint, unwrap
+from omero.sys import ParametersI
+
+DEFAULT_INDEX_PATH = os.environ.get(
+    "THUMBNAIL_INDEX",
+    os.path.join(os.path.expanduser("~"), ".cache", "omero_thumbnail_index.sqlite"),
+)
+
+VECTOR_SIZE = (16, 16)
+"""width and height of the grayscale descriptor, 256 floats per image"""
+
+HASH_SIZE = 8
+"""difference hash edge, HASH_SIZE**2 bits"""
+
+THUMBNAIL_SIZE = 128
+"""longest side of the thumbnails descriptors are computed from"""
+
+Match = namedtuple("Match", ["image_id", "name", "score", "hamming"])
+"""score is the normalized cross correlation of the descriptors, 1 is identical"""
+
+
+def _gray(img):
+    img = np.asarray(img)
+    if img.ndim == 3:
+        img = img[..., :3]
+        img = cv2.cvtColor(np.ascontiguousarray(img, np.uint8), cv2.COLOR_RGB2GRAY)
+    return img.astype(np.float32)
+
+
+def describe(img):
+    """
+    Computes the descriptors of an image.
+
+    Parameters
+    ----------
+    img: PIL.Image.Image or np.ndarray
+        RGB(A) or grayscale image, any size.
+
+    Returns
+    -------
+    (np.ndarray, bytes)
+        zero mean, unit norm float32 vector of the image at VECTOR_SIZE, so the dot
+        product of two is their correlation, and the difference hash as 8 bytes
+    """
+    gray = _gray(img)
+    vector = cv2.resize(gray, VECTOR_SIZE, interpolation=cv2.INTER_AREA).ravel()
+    vector -= vector.mean()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return vector, np.packbits(bits).tobytes()
+
+
+def hammingDistances(hashes, query_hash):
+    """bit differences between every row of hashes (n, 8) uint8 and query_hash bytes"""
+    query = np.frombuffer(query_hash, np.uint8)
+    return np.unpackbits(hashes ^ query, axis=1).sum(axis=1)
+
+
+class ThumbnailIndex:
+    """
+    On-disk descriptors of every OMERO image for finding an image by its appearance.
+
+    update() lists every image with one paginated projection and only fetches
+    thumbnails for images that are new or whose update event changed since they were
+    indexed, deleted images are dropped. Images OMERO cannot render are kept without
+    descriptors, so they are not asked for again until they change. search() compares
+    a query against all descriptors with one matrix product, the matrix is kept in
+    memory between calls.
+
+    Parameters
+    ----------
+    path: str, Default: $THUMBNAIL_INDEX or ~/.cache/omero_thumbnail_index.sqlite
+        sqlite file of the index.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            pragma journal_mode=wal;
+            create table if not exists images (
+                id integer primary key, name text, group_id integer,
+                update_event integer, hash blob, vector blob
+            );
+            """)
+        self._arrays = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute(
+            "select count(*) from images where hash is not null"
+        ).fetchone()[0]
+
+    @staticmethod
+    def _listImages(conn, page_size=10000):
+        """yields (image id, name, group id, update event id, pixels id) of all groups"""
+        query = (
+            "select i.id, i.name, i.details.group.id, i.details.updateEvent.id, p.id "
+            "from Pixels p join p.image i order by i.id"
+        )
+        ctx = {"omero.group": "-1"}
+        query_service = conn.getQueryService()
+        params = ParametersI()
+        offset = 0
+        while True:
+            params.page(offset, page_size)
+            rows = query_service.projection(query, params, ctx)
+            for row in rows:
+                yield tuple(unwrap(row))
+            if len(rows) < page_size:
+                break
+            offset += page_size
+
+    @staticmethod
+    def _fetchThumbnails(conn, group_id, pixels_ids):
+        """returns {pixels id: jpeg bytes}, pixels OMERO could not render are missing"""
+        tb = conn.createThumbnailStore()
+        try:
+            jpegs = tb.getThumbnailByLongestSideSet(
+                rint(THUMBNAIL_SIZE), pixels_ids, {"omero.group": str(group_id)}
+            )
+        finally:
+            tb.close()
+        return {pixels_id: jpeg for pixels_id, jpeg in jpegs.items() if jpeg}
+
+    def update(self, conn, batch_size=100):
+        """
+        Brings the index up to date with the server.
+
+        Parameters
+        ----------
+        conn: omero.gateway.BlitzGateway
+            Connected gateway, images of every group it can read are indexed.
+        batch_size: int, Default: 100
+            Thumbnails fetched per server call.
+
+        Returns
+        -------
+        int
+            number of images added or re-described
+        """
+        stored = dict(self.db.execute("select id, update_event from images"))
+        present = set()
+        changed = {}
+        for image_id, name, group_id, update_event, pixels_id in self._listImages(conn):
+            present.add(image_id)
+            if stored.get(image_id) != update_event:
+                changed.setdefault(group_id, []).append(
+                    (image_id, name, update_event, pixels_id)
+                )
+
+        count = 0
+        for group_id, images in changed.items():
+            for i in range(0, len(images), batch_size):
+                batch = images[i : i + batch_size]
+                jpegs = self._fetchThumbnails(
+                    conn, group_id, [pixels_id for *_, pixels_id in batch]
+                )
+                rows = []
+                for image_id, name, update_event, pixels_id in batch:
+                    jpeg = jpegs.get(pixels_id)
+                    if jpeg is None:
+                        # remembered without descriptors, so it is skipped until changed
+                        rows.append(
+                            (image_id, name, group_id, update_event, None, None)
+                        )
+                        continue
+                    vector, hash_ = describe(Image.open(io.BytesIO(jpeg)))
+                    rows.append(
+                        (
+                            image_id,
+                            name,
+                            group_id,
+                            update_event,
+                            hash_,
+                            vector.tobytes(),
+                        )
+                    )
+                    count += 1
+                # commit per batch so an interrupted update keeps its progress
+                with self.db:
+                    self.db.executemany(
+                        "insert or replace into images values (?, ?, ?, ?, ?, ?)", rows
+                    )
+
+        with self.db:
+            self.db.executemany(
+                "delete from images where id = ?",
+                [(image_id,) for image_id in stored if image_id not in present],
+            )
+        self._arrays = None
+        return count
+
+    def _load(self):
+        if self._arrays is None:
+            rows = self.db.execute(
+                "select id, name, hash, vector from images "
+                "where hash is not null order by id"
+            ).fetchall()
+            ids = np.array([row[0] for row in rows], np.int64)
+            names = [row[1] for row in rows]
+            hashes = np.frombuffer(b"".join(row[2] for row in rows), np.uint8)
+            vectors = np.frombuffer(b"".join(row[3] for row in rows), np.float32)
+            self._arrays = (
+                ids,
+                names,
+                hashes.reshape(len(rows), HASH_SIZE**2 // 8),
+                vectors.reshape(len(rows), VECTOR_SIZE[0] * VECTOR_SIZE[1]),
+            )
+        return self._arrays
+
+    def search(self, img, k=5, max_hamming=None, image_ids=None):
+        """
+        Finds the indexed images looking most like img.
+
+        Parameters
+        ----------
+        img: PIL.Image.Image or np.ndarray
+            Query image, ex: a large recon.
+        k: int, Default: 5
+            Most matches returned.
+        max_hamming: int, optional
+            Only consider images whose difference hash is at most this many bits away.
+        image_ids: iterable[int], optional
+            Only consider these images, ex: a dataset's.
+
+        Returns
+        -------
+        list[Match]
+            best first
+        """
+        ids, names, hashes, vectors = self._load()
+        if not len(ids):
+            return []
+        vector, hash_ = describe(img)
+        scores = vectors @ vector
+        hamming = hammingDistances(hashes, hash_)
+        candidates = np.ones(len(ids), bool)
+        if max_hamming is not None:
+            candidates &= hamming <= max_hamming
+        if image_ids is not None:
+            candidates &= np.isin(ids, np.fromiter(image_ids, np.int64))
+        candidates = np.flatnonzero(candidates)
+        if len(candidates) > k:
+            top = np.argpartition(-scores[candidates], k - 1)[:k]
+            candidates = candidates[top]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [
+            Match(int(ids[i]), names[i], float(scores[i]), int(hamming[i]))
+            for i in candidates
+        ]
@@ -0,0 +1,238 @@
+import io
+import os
+import glob
+import queue
+import tempfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from omero.rtypes import rint, unwrap
+from omero.sys import ParametersI
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "THUMBNAIL_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "omero_thumbnails"),
+)
+
+ImageVersion = namedtuple("ImageVersion", ["update_event", "group_id", "pixels_id"])
+
+
+class SessionPool:
+    """
+    Connections joined to one session, each used by a single thread at a time.
+
+    Connections are cloned from conn as they are first needed, up to size.
+    """
+
+    def __init__(self, conn, size=4):
+        self.conn = conn
+        self.size = size
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                self.created += create
+            if create:
+                conn = self.conn.clone()
+                conn.connect(sUuid=self.conn.c.getSessionId())
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        """detaches the connections, the session itself stays open"""
+        while True:
+            try:
+                self.idle.get_nowait().close(hard=False)
+            except queue.Empty:
+                return
+
+
+class ThumbnailProvider:
+    """
+    Fetches thumbnails in batches over several connections and caches them on disk.
+
+    Cached thumbnails are named after the image id, size and the image's last update
+    event, so a thumbnail is fetched again once its image changes. Missing thumbnails
+    are requested through the thumbnail set API, batch_size images per call and up to
+    workers calls at once, each on its own connection of a SessionPool. Images the set
+    cannot render are fetched one by one, images that fail that too get a blank
+    placeholder. Changed rendering settings do not update the image, clear cache_dir to
+    pick those up.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway
+        Connected gateway the pool's connections join.
+    size: int or tuple(int, int), Default: (256, 256)
+        Longest side, keeping the aspect ratio, or exact width and height.
+    cache_dir: str, Default: $THUMBNAIL_CACHE or ~/.cache/omero_thumbnails
+        Where thumbnails are stored.
+    workers: int, Default: 4
+        Concurrent thumbnail set calls and pooled connections.
+    batch_size: int, Default: 50
+        Images per thumbnail set call.
+    """
+
+    def __init__(
+        self,
+        conn,
+        size=(256, 256),
+        cache_dir=DEFAULT_CACHE_DIR,
+        workers=4,
+        batch_size=50,
+    ):
+        self.size = size
+        self.tag = f"{size[0]}x{size[1]}" if isinstance(size, tuple) else str(size)
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.pool = SessionPool(conn, workers)
+        self.executor = ThreadPoolExecutor(workers)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+
+    def _path(self, image_id, update_event):
+        return os.path.join(self.cache_dir, f"{image_id}_{self.tag}_{update_event}.jpg")
+
+    def _read(self, image_id, version):
+        try:
+            with open(self._path(image_id, version.update_event), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, image_id, version, jpeg):
+        path = self._path(image_id, version.update_event)
+        for stale in glob.glob(
+            os.path.join(self.cache_dir, f"{image_id}_{self.tag}_*.jpg")
+        ):
+            if stale != path:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(jpeg)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _versions(self, image_ids, chunk=1000):
+        """{image id: ImageVersion} of the images visible in any group"""
+        query = (
+            "select i.id, i.details.updateEvent.id, i.details.group.id, p.id "
+            "from Pixels p join p.image i where i.id in (:ids)"
+        )
+        rv = {}
+        with self.pool.connection() as conn:
+            query_service = conn.getQueryService()
+            for i in range(0, len(image_ids), chunk):
+                params = ParametersI()
+                params.addIds(image_ids[i : i + chunk])
+                rows = query_service.projection(query, params, {"omero.group": "-1"})
+                for row in rows:
+                    image_id, *version = unwrap(row)
+                    rv[image_id] = ImageVersion(*version)
+        return rv
+
+    def _fetch(self, group_id, batch):
+        """fetches and caches one thumbnail set, returns {image id: jpeg bytes}"""
+        pixels_ids = [version.pixels_id for _, version in batch]
+        ctx = {"omero.group": str(group_id)}
+        with self.pool.connection() as conn:
+            tb = conn.createThumbnailStore()
+            try:
+                if isinstance(self.size, tuple):
+                    jpegs = tb.getThumbnailSet(
+                        rint(self.size[0]), rint(self.size[1]), pixels_ids, ctx
+                    )
+                else:
+                    jpegs = tb.getThumbnailByLongestSideSet(
+                        rint(self.size), pixels_ids, ctx
+                    )
+            finally:
+                tb.close()
+        rv = {}
+        for image_id, version in batch:
+            jpeg = jpegs.get(version.pixels_id)
+            if jpeg:
+                self._write(image_id, version, jpeg)
+                rv[image_id] = jpeg
+        return rv
+
+    def getJpegs(self, imgs):
+        """returns the jpeg bytes of imgs' thumbnails in order, None if not renderable"""
+        image_ids = list(dict.fromkeys(img.getId() for img in imgs))
+        versions = self._versions(image_ids)
+        jpegs = {}
+        misses = {}
+        for image_id, version in versions.items():
+            jpeg = self._read(image_id, version)
+            if jpeg is None:
+                misses.setdefault(version.group_id, []).append((image_id, version))
+            else:
+                jpegs[image_id] = jpeg
+        futures = [
+            self.executor.submit(self._fetch, group_id, batch[i : i + self.batch_size])
+            for group_id, batch in misses.items()
+            for i in range(0, len(batch), self.batch_size)
+        ]
+        for future in futures:
+            jpegs.update(future.result())
+        rv = []
+        for img in imgs:
+            jpeg = jpegs.get(img.getId())
+            if jpeg is None:  # the set skips what it cannot render, ask for those alone
+                jpeg = img.getThumbnail(self.size)
+            rv.append(jpeg)
+        return rv
+
+    def get(self, imgs):
+        """
+        Gets the thumbnails of imgs, from the cache where possible.
+
+        Parameters
+        ----------
+        imgs: list[omero.gateway.ImageWrapper]
+            Images to get thumbnails of.
+
+        Returns
+        -------
+        list[PIL.Image.Image]
+            in the order of imgs, blank where OMERO cannot render the image
+        """
+        return [
+            self._placeholder() if jpeg is None else Image.open(io.BytesIO(jpeg))
+            for jpeg in self.getJpegs(imgs)
+        ]
+
+    def _placeholder(self):
+        """uniform white thumbnail, it correlates with nothing so it never matches"""
+        size = self.size if isinstance(self.size, tuple) else (self.size, self.size)
+        return Image.new("RGB", size, (255, 255, 255))
@@ -1,20 +1,247 @@
+import numpy as np
 import omero
 from omero import scripts, gateway
-from omero.rtypes import wrap, rdouble
+from omero.rtypes import wrap, rdouble, rstring, unwrap
+
+POINT_FIELDS = (("x", "y"), ("x1", "y1"), ("x2", "y2"))
+"""coordinate pairs moved as points, x/y of rectangles and ellipses are handled with their size"""
+
+COPIED_FIELDS = ("fillColor", "strokeColor", "strokeWidth")
+
+ELLIPSE_POLYGON_POINTS = 64
+"""vertices used when an ellipse no longer fits its primitive form"""
+
+
+def getImage(conn, image):
+    """if is integer, assume an id, else filename"""
+    try:
+        return conn.getObject("image", int(image))
+    except ValueError:
+        return conn.getObject("image", attributes={"name": image})
+
+
+def parsePoints(point_strings):
+    """parses many "x,y x,y" strings in one pass, returns (n,2) coords and offsets"""
+    counts = np.array([s.count(",") for s in point_strings], np.int64)
+    xy = np.fromstring(" ".join(point_strings).replace(",", " "), sep=" ")
+    offsets = np.zeros(len(counts) + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return xy.reshape(-1, 2), offsets
+
+
+def formatPoints(xy, offsets):
+    """inverse of parsePoints"""
+    xy = xy.astype(str)
+    pairs = np.char.add(np.char.add(xy[:, 0], ","), xy[:, 1])
+    return [" ".join(pairs[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def parseAffine(values):
+    """
+    Builds a 2x3 affine matrix from 6 (row major 2x3) or 9 (3x3) numbers.
+
+    Accepts a sequence of numbers or a whitespace/comma separated string.
+    """
+    if isinstance(values, str):
+        values = values.replace(",", " ").split()
+    matrix = np.asarray(values, np.float64).ravel()
+    if matrix.size == 9:
+        return matrix.reshape(3, 3)[:2]
+    if matrix.size == 6:
+        return matrix.reshape(2, 3)
+    raise ValueError(f"An affine needs 6 or 9 values, got {matrix.size}")
+
+
+def getStoredTransform(conn, fileAnnotationId):
+    """loads an affine saved as a text FileAnnotation, ex: a registration transform"""
+    annotation = conn.getObject("FileAnnotation", fileAnnotationId)
+    if annotation is None:
+        raise ValueError(f"FileAnnotation {fileAnnotationId} not found")
+    text = b"".join(annotation.getFileInChunks()).decode()
+    return parseAffine(text)
+
+
+def _applyAffine(xy, affine):
+    return xy @ affine[:, :2].T + affine[:, 2]
+
+
+def _isAxisAligned(affine):
+    """true when rectangles stay rectangles, allows flips and 90 degree turns"""
+    linear = np.abs(affine[:, :2])
+    tol = 1e-9 * linear.max()
+    return bool(((linear[:, 0] <= tol) | (linear[:, 1] <= tol)).all())
+
+
+def _setField(shape, field, value):
+    getattr(shape, "set" + field[0].upper() + field[1:])(rdouble(value))
+
+
+def _hasField(shape, field):
+    return getattr(shape, "_" + field, None) is not None
+
+
+def transformShapes(shapes, affine):
+    """
+    Creates copies of shapes moved by a 2x3 affine matrix.
+
+    Each kind of geometry is transformed for all shapes in one array operation. Rectangles
+    and ellipses keep their primitive form while the affine keeps them axis aligned,
+    otherwise they become polygons.
+    """
+    affine = np.asarray(affine, np.float64)
+    axisAligned = _isAxisAligned(affine)
+    linear = np.abs(affine[:, :2])
+
+    rects = [i for i, s in enumerate(shapes) if _hasField(s, "width")]
+    ellipses = [i for i, s in enumerate(shapes) if _hasField(s, "radiusX")]
+    primitives = set(rects) | set(ellipses)
+    toPolygon = set() if axisAligned else primitives
+    newShapes = [
+        omero.model.PolygonI() if i in toPolygon else type(shape)()
+        for i, shape in enumerate(shapes)
+    ]
+    polygonPoints = {}
+
+    for xField, yField in POINT_FIELDS:
+        idx = [i for i, s in enumerate(shapes)
+               if i not in primitives and _hasField(s, xField)]
+        if not idx:
+            continue
+        xy = np.array([[getattr(shapes[i], "_" + xField).getValue(),
+                        getattr(shapes[i], "_" + yField).getValue()] for i in idx])
+        for i, (x, y) in zip(idx, _applyAffine(xy, affine).tolist()):
+            _setField(newShapes[i], xField, x)
+            _setField(newShapes[i], yField, y)
+
+    if rects:
+        # x, y, width, height
+        box = np.array([[shapes[i].getX().getValue(), shapes[i].getY().getValue(),
+                         shapes[i].getWidth().getValue(),
+                         shapes[i].getHeight().getValue()] for i in rects])
+        corners = np.stack([box[:, :2], box[:, :2] + box[:, 2:] * [1, 0],
+                            box[:, :2] + box[:, 2:], box[:, :2] + box[:, 2:] * [0, 1]],
+                           axis=1)
+        corners = _applyAffine(corners, affine)
+        if axisAligned:
+            lo = corners.min(axis=1)
+            size = corners.max(axis=1) - lo
+            for i, (x, y), (w, h) in zip(rects, lo.tolist(), size.tolist()):
+                for field, value in zip(("x", "y", "width", "height"), (x, y, w, h)):
+                    _setField(newShapes[i], field, value)
+        else:
+            polygonPoints.update(zip(rects, corners))
+
+    if ellipses:
+        # x, y, radiusX, radiusY
+        ell = np.array([[shapes[i].getX().getValue(), shapes[i].getY().getValue(),
+                         shapes[i].getRadiusX().getValue(),
+                         shapes[i].getRadiusY().getValue()] for i in ellipses])
+        centers = _applyAffine(ell[:, :2], affine)
+        if axisAligned:
+            # one of each row is zero, so this either scales or swaps the radii
+            radii = ell[:, 2:] @ linear.T
+            for i, (x, y), (rx, ry) in zip(ellipses, centers.tolist(), radii.tolist()):
+                for field, value in zip(("x", "y", "radiusX", "radiusY"), (x, y, rx, ry)):
+                    _setField(newShapes[i], field, value)
+        else:
+            theta = np.linspace(0, 2 * np.pi, ELLIPSE_POLYGON_POINTS, endpoint=False)
+            unit = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+            outline = ell[:, None, :2] + ell[:, None, 2:] * unit
+            polygonPoints.update(zip(ellipses, _applyAffine(outline, affine)))
+
+    idx = [i for i, s in enumerate(shapes) if _hasField(s, "points")]
+    if idx:
+        xy, offsets = parsePoints([shapes[i].getPoints().getValue() for i in idx])
+        xy = _applyAffine(xy, affine)
+        for i, start, end in zip(idx, offsets[:-1], offsets[1:]):
+            polygonPoints[i] = xy[start:end]
+
+    if polygonPoints:
+        idx = list(polygonPoints)
+        offsets = np.zeros(len(idx) + 1, np.int64)
+        np.cumsum([len(polygonPoints[i]) for i in idx], out=offsets[1:])
+        xy = np.concatenate([polygonPoints[i] for i in idx])
+        for i, points in zip(idx, formatPoints(xy, offsets)):
+            newShapes[i].setPoints(rstring(points))
+
+    for shape, newShape in zip(shapes, newShapes):
+        for field in COPIED_FIELDS:
+            if hasattr(shape, field):
+                setattr(newShape, field, getattr(shape, field))
+    return newShapes
+
+
+def scaleShapes(shapes, scaleFactor):
+    """Creates copies of shapes scaled by (x, y) scaleFactor."""
+    return transformShapes(
+        shapes, [[scaleFactor[0], 0, 0], [0, scaleFactor[1], 0]]
+    )
+
+
+def transposeRois(conn, imageOne, imageTwo, batchSize=500, affine=None):
+    """
+    Scales all ROIs of imageOne onto imageTwo and saves them in chunks of batchSize.
+
+    A 2x3 affine (ex: from a registration) replaces the size based scaling when given.
+    Returns the number of ROIs saved.
+    """
+    updateService = conn.getUpdateService()
+    roiService = conn.getRoiService()
+
+    rois = roiService.findByImage(imageOne.getId(), None).rois
+    if affine is None:
+        affine = [[imageTwo.getSizeX() / imageOne.getSizeX(), 0, 0],
+                  [0, imageTwo.getSizeY() / imageOne.getSizeY(), 0]]
+
+    # transform every shape of the image together, then split back per roi
+    shapes = [roi.copyShapes() for roi in rois]
+    newShapes = transformShapes([s for roiShapes in shapes for s in roiShapes], affine)
+
+    newRois = []
+    start = 0
+    for roiShapes in shapes:
+        newRoi = omero.model.RoiI()
+        newRoi.addAllShapeSet(newShapes[start:start + len(roiShapes)])
+        newRoi.setImage(omero.model.ImageI(imageTwo.getId(), False))
+        newRois.append(newRoi)
+        start += len(roiShapes)
+
+    for i in range(0, len(newRois), batchSize):
+        updateService.saveArray(newRois[i:i + batchSize])
+    return len(newRois)
+
 
-            
 if __name__ == "__main__":
     client = scripts.client(
-        'Transpose ROIs', """Takes ROIs from Image 1 and scales them onto Image 2""",
+        'Transpose ROIs', """Takes ROIs from Image 1 and scales them onto Image 2.
+Comma separate Image_1 and Image_2 to transpose many pairs at once.
+Affine mode applies Affine_Matrix or the matrix stored in Transform_File to every pair instead.""",
         scripts.String(
             "Image_1", optional=False, grouping="1",
-            description="The filename or id of an Image"
+            description="The filename(s) or id(s) of the source Image(s)"
         ),
         scripts.String(
             "Image_2", optional=False, grouping="2",
-            description="The filename or id of an Image"
+            description="The filename(s) or id(s) of the target Image(s)"
+        ),
+        scripts.Int(
+            "Batch_Size", optional=True, grouping="3", default=500, min=1,
+            description="How many ROIs to save per server call"
         ),
-        version="1",
+        scripts.String(
+            "Mode", optional=True, grouping="4", default="Scale",
+            values=[wrap("Scale"), wrap("Affine")],
+            description="Scale by image size or apply an affine transform"
+        ),
+        scripts.String(
+            "Affine_Matrix", optional=True, grouping="4.1",
+            description="6 (2x3) or 9 (3x3) comma separated values, row major"
+        ),
+        scripts.Long(
+            "Transform_File", optional=True, grouping="4.2",
+            description="FileAnnotation id of a stored 2x3 or 3x3 transform"
+        ),
+        version="3",
         authors=["Michael Barrett"],
         institutions=["LaViolette Lab"],
         contact="mjbarrett@mcw.edu",
@@ -23,71 +250,37 @@ if __name__ == "__main__":
     try:
         conn = gateway.BlitzGateway(client_obj=client)
 
-        updateService = conn.getUpdateService()
-        roiService = conn.getRoiService()
-
-        imageOne = client.getInput("Image_1", unwrap=True)
-        imageTwo = client.getInput("Image_2", unwrap=True)
-
-        # if is integer, assume an id, else filename
-        try: # parse imageOne
-            id=int(imageOne)
-            imageOne=conn.getObject("image",imageOne)
-        except ValueError:
-            imageOne=conn.getObject("image",attributes={"name":imageOne})
-        try: # parse imageTwo
-            id=int(imageTwo)
-            imageTwo=conn.getObject("image",imageTwo)
-        except ValueError:
-            imageTwo=conn.getObject("image",attributes={"name":imageTwo})
-
-        shapes = []
-
-        result = roiService.findByImage(imageOne.getId(), None)
-        scaleFactor = [imageTwo.getSizeX() / imageOne.getSizeX(),
-                        imageTwo.getSizeY() / imageOne.getSizeY()]
-                        
-        for roi in result.rois:
-            newRoi=gateway.RoiWrapper(conn,omero.model.RoiI())
-            for shape in roi.copyShapes():
-                newShape=type(shape)()
-                if hasattr(shape, "_x"):
-                    newShape.setX(rdouble(shape.getX().getValue() * scaleFactor[0]))
-                if hasattr(shape, "_y"):
-                    newShape.setY(rdouble(shape.getY().getValue() * scaleFactor[1]))
-                    
-                if hasattr(shape, "_width"):
-                    newShape.setWidth(rdouble(shape.getWidth().getValue() * scaleFactor[0]))
-                if hasattr(shape, "_height"):
-                    newShape.setHeight(rdouble(shape.getHeight().getValue() * scaleFactor[1]))
-                    
-                if hasattr(shape, "_radiusX"):
-                    newShape.setRadiusX(rdouble(shape.getRadiusX().getValue() * scaleFactor[0]))
-                if hasattr(shape, "_radiusY"):
-                    newShape.setRadiusY(rdouble(shape.getRadiusY().getValue() * scaleFactor[1]))
-
-                if hasattr(shape, "_points"):
-                    pointStrArr = shape.getPoints().getValue().split(" ")
-                    rv = ""
-                    for pointStr in pointStrArr:
-                        coordList=pointStr.split(",")
-                        rv+=str(float(coordList[0]) * scaleFactor[0])+ "," +\
-                            str(float(coordList[1]) * scaleFactor[1])+ " "
-                    newShape.setPoints(wrap(rv))
-                
-                if hasattr(shape, "fillColor"): newShape.fillColor=shape.fillColor
-                if hasattr(shape, "strokeColor"): newShape.strokeColor=shape.strokeColor
-                if hasattr(shape, "strokeWidth"): newShape.strokeWidth=shape.strokeWidth
-
-                newRoi.addShape(newShape)
-                
-            newRoi.setImage(imageTwo._obj)
-            updateService.saveAndReturnObject(newRoi._obj)
-        client.setOutput("Message", wrap("Success!"))
+        imagesOne = [s.strip() for s in client.getInput("Image_1", unwrap=True).split(",")]
+        imagesTwo = [s.strip() for s in client.getInput("Image_2", unwrap=True).split(",")]
+        batchSize = unwrap(client.getInput("Batch_Size")) or 500
+        if len(imagesOne) != len(imagesTwo):
+            raise ValueError("Image_1 and Image_2 need the same number of images")
+
+        affine = None
+        if unwrap(client.getInput("Mode")) == "Affine":
+            matrix = unwrap(client.getInput("Affine_Matrix"))
+            transformFile = unwrap(client.getInput("Transform_File"))
+            if matrix:
+                affine = parseAffine(matrix)
+            elif transformFile is not None:
+                affine = getStoredTransform(conn, transformFile)
+            else:
+                raise ValueError("Affine mode needs Affine_Matrix or Transform_File")
+
+        messages = []
+        for imageOne, imageTwo in zip(imagesOne, imagesTwo):
+            try:
+                count = transposeRois(conn, getImage(conn, imageOne),
+                                      getImage(conn, imageTwo), batchSize, affine)
+                messages.append(f"{imageOne}->{imageTwo}: {count} ROIs")
+            except Exception as e:
+                print(e)
+                messages.append(f"{imageOne}->{imageTwo}: Failed")
+        client.setOutput("Message", wrap("; ".join(messages)))
 
     except Exception as e:
         print(e)
         client.setOutput("Message", wrap("Failed"))
 
     finally:
-        client.closeSession()
\ No newline at end of file
+        client.closeSession()